@@ -5,7 +5,7 @@ from urlobject import URLObject
 
 import config
 import log
-from cache_client import get_from_cache, add_to_cache
+from cache_client import get_from_cache, add_to_cache, set_many
 
 
 
@@ -15,7 +15,7 @@ def get_session_tests(session):
     2. If found in cache, return tests
     3. If not found in cache, query tests from session and convert them to objects
     4. update session with tests in cache, to be kept for 2 days
-    5. update tests separately in cache as well
+    5. update tests separately in cache as well, all of them in a single call
     :type session: backslash.session.Session
     :rtype: list(backslash.test.Test)
     """
@@ -28,8 +28,7 @@ def get_session_tests(session):
         log.info(f"Session {session.id} wasn't found in cache")
         tests = [test for test in session.query_tests()]
         add_to_cache(session_key, tests, days_to_keep=2)
-        for test in tests:
-            add_to_cache(test.id, test)
+        set_many({test.id: test for test in tests})
     return tests
 
 
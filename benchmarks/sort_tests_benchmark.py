@@ -0,0 +1,54 @@
+"""
+Compare sorting tests by their formatted start time string, as it was done before, with sorting
+them by their numeric start time.
+Run from the project root: PYTHONPATH=. python benchmarks/sort_tests_benchmark.py
+"""
+import random
+import time
+
+import arrow
+
+from elastic_search_queries import InternalTest
+from processing_tests import _sort_tests
+
+NUM_OF_TESTS = 100000
+
+
+def _create_tests(num_of_tests):
+    now = time.time()
+    tests = []
+    for index in range(num_of_tests):
+        start_time = now - random.uniform(0, 30 * 24 * 60 * 60)
+        tests.append(InternalTest({'_source': {'status': 'SUCCESS',
+                                               'logical_id': f"{index}_1",
+                                               'test': {'name': f"test_{index % 1000}",
+                                                        'file_name': "tests/test_file.py"},
+                                               'start_time': start_time,
+                                               'end_time': start_time + 60}},
+                                  test_params=False, jira_tickets=False))
+    return tests
+
+
+def _sort_by_formatted_time(tests):
+    tests.sort(key=lambda test: arrow.get(test.start_time, 'DD-MM-YY HH:mm:ss').float_timestamp,
+               reverse=True)
+    return tests
+
+
+def _measure(sort_function, tests):
+    start_time = time.perf_counter()
+    sort_function(tests)
+    return time.perf_counter() - start_time
+
+
+def main():
+    tests = _create_tests(NUM_OF_TESTS)
+    formatted_time = _measure(_sort_by_formatted_time, list(tests))
+    numeric_time = _measure(_sort_tests, list(tests))
+    print(f"Sorting {NUM_OF_TESTS} tests:")
+    print(f"  by formatted start time: {formatted_time:.3f}s")
+    print(f"  by numeric start time:   {numeric_time:.3f}s ({formatted_time / numeric_time:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
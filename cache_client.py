@@ -1,80 +1,534 @@
+import atexit
+import functools
+import hashlib
+import os
 import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import rpyc
-from socket import gaierror
+
+from cachetools import TLRUCache
+from cachetools.keys import hashkey
 
 import config
 import log
+from cache_codec import encode, decode, LIST_ITEM_PROTOCOL
+from exceptions import document_exception
+
 
+CONNECTION_ERRORS = (EOFError, OSError, rpyc.AsyncResultTimeout)
 
-def connect_to_cache():
-    if config.get_cache_state():
+
+class ConnectionPool(object):
+    """
+    Pool of connections to the cache server, that are reused by all the cache calls of the process:
+    1. Each call takes an idle connection, or opens a new one, and returns it to the pool when done,
+        so concurrent threads and greenlets never share a connection
+    2. Connections that were idle for more than config.cache_health_check_interval are pinged
+        before they are used, and broken connections are closed and replaced
+    3. If the cache server can't be reached, the cache is disabled, and connecting is retried only
+        after config.cache_retry_interval, so the cache recovers when the server is back
+    """
+
+    def __init__(self, url, port, max_size=config.cache_pool_size):
+        self.url = url
+        self.port = port
+        self.max_size = max_size
+        self._idle_connections = []
+        self._lock = threading.Lock()
+        self._disabled_at = None
+
+    @contextmanager
+    def connection(self):
+        """
+        Yield a healthy connection, or None if the cache is disabled. If the connection failed
+        during the call, the server was probably restarted, so it's closed with all the idle
+        connections instead of returning to the pool
+        :rtype: rpyc.Connection
+        """
+        connection = self._get_idle_connection() or self._connect()
+        if connection is None:
+            yield None
+            return
         try:
-            return rpyc.connect(config.cache_server.url, config.cache_server.port)
-        except gaierror as e:
+            yield connection
+        except CONNECTION_ERRORS:
+            self._close(connection)
+            self.close_idle_connections()
+            raise
+        except Exception:
+            self._release(connection)
+            raise
+        self._release(connection)
+
+    def _get_idle_connection(self):
+        while True:
+            with self._lock:
+                if not self._idle_connections:
+                    return None
+                connection, last_used = self._idle_connections.pop()
+            if self._is_healthy(connection, last_used):
+                return connection
+            self._close(connection)
+
+    def close_idle_connections(self):
+        with self._lock:
+            idle_connections = self._idle_connections
+            self._idle_connections = []
+        for connection, _ in idle_connections:
+            self._close(connection)
+
+    @staticmethod
+    def _is_healthy(connection, last_used):
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < config.cache_health_check_interval:
+            return True
+        try:
+            connection.ping(timeout=config.cache_timeout)
+            return True
+        except CONNECTION_ERRORS as e:
+            log.debug(f"Cache server connection is broken: {e}")
+            return False
+
+    def _connect(self):
+        if not config.get_cache_state():
+            if self._disabled_at is None or \
+                    time.monotonic() - self._disabled_at < config.cache_retry_interval:
+                return None
+            log.info("Retrying to connect to cache server")
+        try:
+            connection = rpyc.connect(self.url, self.port,
+                                      config={"sync_request_timeout": config.cache_timeout})
+        except CONNECTION_ERRORS as e:
+            self._disabled_at = time.monotonic()
             config.set_cache_state(False)
             log.error(f"Failed to connect to redis server: {e}")
+            return None
+        if not config.get_cache_state():
+            log.info("Cache server is back, enabling cache")
+            config.set_cache_state(True)
+        return connection
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle_connections) < self.max_size:
+                self._idle_connections.append((connection, time.monotonic()))
+                return
+        self._close(connection)
+
+    @staticmethod
+    def _close(connection):
+        with document_exception("Failed to close cache server connection"):
+            connection.close()
+
+
+class LocalCache(object):
+    """
+    LRU of the unpickled objects that were got from the cache server, with their generation on the
+    server. The size of each object is estimated as the size of its pickled value times
+    size_factor, and the least recently used objects are evicted when the total size exceeds
+    max_bytes
+    """
+
+    def __init__(self, max_bytes=config.local_cache_max_bytes,
+                 size_factor=config.local_cache_size_factor):
+        self.max_bytes = max_bytes
+        self.size_factor = size_factor
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key_name):
+        """
+        Return the generation and the object of the key, or None if it isn't kept
+        :type key_name: Union(str, int)
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self._entries.get(key_name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key_name)
+            return entry[0], entry[1]
+
+    def put(self, key_name, generation, data, size):
+        size *= self.size_factor
+        with self._lock:
+            self._pop(key_name)
+            if size > self.max_bytes:
+                return
+            self._entries[key_name] = (generation, data, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def pop(self, key_name):
+        with self._lock:
+            self._pop(key_name)
+
+    def _pop(self, key_name):
+        entry = self._entries.pop(key_name, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+_pool = ConnectionPool(config.cache_server.url, config.cache_server.port)
+_local_cache = LocalCache()
+
+
+def call_cache_server(method_name, *args):
+    """
+    1. Call the exposed method of the cache server using a pooled connection
+    2. If the connection broke during the call (e.g. the server was restarted), retry once with a
+        new connection
+    3. Return None if the cache is disabled
+    :type method_name: str
+    """
+    for attempt in range(2):
+        try:
+            with _pool.connection() as connection:
+                if connection is None:
+                    return None
+                return getattr(connection.root, method_name)(*args)
+        except CONNECTION_ERRORS as e:
+            if attempt:
+                log.error(f"Cache server call {method_name} failed: {e}")
+
+
+def _encode(data):
+    return encode(data, compression=config.cache_compression,
+                  threshold=config.cache_compression_threshold)
 
 
 def add_to_cache(key_name, data, days_to_keep=None):
     """
-    1. Serialize given object
+    1. Serialize given object, see cache_codec.encode
     2. Send object to cache server
-    3. If days to keep = 0, keep forever
+    3. If days to keep = 0, keep forever. Days to keep may be a fraction of a day
     :type key_name: Union(str, int)
     :type data: object
-    :type days_to_keep: int
+    :type days_to_keep: Union(int, float)
     """
-    pickled_object = pickle.dumps(data)
-    connection = connect_to_cache()
-    if connection:
-        connection.root.exposed_add_to_cache(key_name, pickled_object, days_to_keep)
+    pickled_object = _encode(data)
+    _local_cache.pop(key_name)
+    call_cache_server("exposed_add_to_cache", key_name, pickled_object, days_to_keep)
 
 
 def update_cache(key_name, new_data):
     """
-    1. Get data and check whether the specified key exists
-    2. If exists:
-        2.1 Check whether it's a list, and if not, covert it to list
-        2.2 If new data is not in the list, add it to the list, otherwise return
-    3. If doesn't exist:
-        3.1 Convert data to list
-    3. Update cache with updated entry
+    Append new data to the list of the specified key, unless it's already in the list. The list
+    is created if the key doesn't exist. The cache server appends the data atomically, so the list
+    itself isn't transferred
     :type key_name: Union(str, int)
     :type new_data: object
     """
-    entry = get_from_cache(key_name)
-    if entry:
-        if not isinstance(entry, list):
-            entry = list(entry)
-        if new_data not in entry:
-            entry.append(new_data)
-        else:
-            return
-    else:
-        entry = [new_data]
-    add_to_cache(key_name, entry)
+    _local_cache.pop(key_name)
+    call_cache_server("exposed_append_to_list", key_name,
+                      pickle.dumps(new_data, protocol=LIST_ITEM_PROTOCOL))
 
 
 def get_from_cache(key_name):
     """
-    1. Connect to cache
-    2. If cache returned an object, unpickle it and return
+    1. If the object is kept in the local cache, send its generation to the cache server, and if
+        it wasn't changed since, return the local object without transferring it again
+    2. If cache returned an object, decode it, keep it in the local cache and return it. Lists
+        that were created by update_cache are returned as tuple of pickled items
+    3. Objects that can't be decoded by this process (compressed by a library that isn't
+        installed) are treated as missing
+    4. The returned object may be shared with other callers, so it must not be modified
     :type key_name: Union(str, int)
     """
-    connection = connect_to_cache()
-    if connection:
-        pickled_object = connection.root.exposed_get_from_cache(key_name)
+    local_entry = _local_cache.get(key_name)
+    result = call_cache_server("exposed_get_if_changed", key_name,
+                               local_entry[0] if local_entry else None)
+    if not result:
+        _local_cache.pop(key_name)
+        return None
+    generation = result[0]
+    if len(result) == 1:
+        return local_entry[1]
+    pickled_object = result[1]
+    try:
+        if isinstance(pickled_object, tuple):
+            data = [decode(item) for item in pickled_object]
+            size = sum(len(item) for item in pickled_object)
+        elif pickled_object:
+            data = decode(pickled_object)
+            size = len(pickled_object)
+        else:
+            return None
+    except ValueError as e:
+        log.warning(f"Failed to decode {key_name} from cache: {e}")
+        return None
+    if generation is not None:
+        _local_cache.put(key_name, generation, data, size)
+    return data
+
+
+def get_many(key_names):
+    """
+    1. Get the objects of all the keys from cache in a single call
+    2. Decode the objects that were found and return them by their keys. Objects that can't be
+        decoded are treated as missing, as in get_from_cache
+    :type key_names: iterable
+    :rtype: dict
+    """
+    key_names = tuple(key_names)
+    pickled_objects = call_cache_server("exposed_get_many", key_names) or ()
+    objects = {}
+    for key_name, pickled_object in zip(key_names, pickled_objects):
         if pickled_object:
-            return pickle.loads(pickled_object)
+            try:
+                objects[key_name] = decode(pickled_object)
+            except ValueError as e:
+                log.warning(f"Failed to decode {key_name} from cache: {e}")
+    return objects
+
+
+def set_many(items, days_to_keep=None):
+    """
+    Serialize all the objects and send them to the cache server in a single call
+    :type items: dict
+    :type days_to_keep: Union(int, float)
+    """
+    pickled_items = tuple((key_name, _encode(data)) for key_name, data in items.items())
+    for key_name in items:
+        _local_cache.pop(key_name)
+    if pickled_items:
+        call_cache_server("exposed_set_many", pickled_items, days_to_keep)
 
 
-def redis_cache(func):
+def redis_cache(func=None, key_builder=None, ttl_days=None,
+                lock_timeout=config.cache_lock_timeout):
+    """
+    Cache the results of the decorated function in the cache server:
+    1. The key is built from the function name and all of its arguments, unless key_builder is
+        given, that gets the same arguments as the function and returns the key
+    2. Any result but None is cached, for ttl_days if given, otherwise forever
+    3. Only one caller, in all the processes, computes a missing result, while the others wait for
+        it to be cached, up to lock_timeout seconds
+    Can be used both as @redis_cache and as @redis_cache(key_builder=..., ttl_days=...)
+    :type func: function
+    :type key_builder: function
+    :type ttl_days: Union(int, float)
+    :type lock_timeout: int
+    """
+    if func is None:
+        return functools.partial(redis_cache, key_builder=key_builder, ttl_days=ttl_days,
+                                 lock_timeout=lock_timeout)
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        key_name = args[0]
+        key_name = key_builder(*args, **kwargs) if key_builder else \
+            _get_function_key(func, args, kwargs)
         result = get_from_cache(key_name)
-        if result:
+        if result is not None:
             return result
-        result = func(*args, **kwargs)
-        add_to_cache(key_name, result)
+        with single_flight(key_name, lock_timeout) as result_getter:
+            result = result_getter()
+            if result is None:
+                result = func(*args, **kwargs)
+                if result is not None:
+                    add_to_cache(key_name, result, days_to_keep=ttl_days)
         return result
     return wrapper
+
+
+def _get_function_key(func, args, kwargs):
+    arguments = repr((args, sorted(kwargs.items())))
+    return f"{func.__module__}.{func.__qualname__}_{hashlib.sha1(arguments.encode()).hexdigest()}"
+
+
+@contextmanager
+def single_flight(key_name, lock_timeout=config.cache_lock_timeout):
+    """
+    1. Try to acquire the lock of the key in the cache server. If another caller holds it, wait
+        until it's released or the key is cached, polling every config.cache_lock_poll_interval
+    2. Yield function that returns the cached value of the key, so the caller can check whether
+        it was computed while waiting. If the lock wasn't acquired in lock_timeout seconds (e.g.
+        its holder is stuck) or the cache is disabled, the caller computes the value without the
+        lock
+    3. Release the lock when the caller is done
+    :type key_name: Union(str, int)
+    :type lock_timeout: int
+    """
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + lock_timeout
+    is_acquired = call_cache_server("exposed_acquire_lock", key_name, token, lock_timeout)
+    while is_acquired is False and time.monotonic() < deadline:
+        log.info(f"Waiting for {key_name} to be computed by another caller")
+        time.sleep(config.cache_lock_poll_interval)
+        if get_from_cache(key_name) is not None:
+            break
+        is_acquired = call_cache_server("exposed_acquire_lock", key_name, token, lock_timeout)
+    try:
+        yield lambda: get_from_cache(key_name)
+    finally:
+        if is_acquired:
+            call_cache_server("exposed_release_lock", key_name, token)
+
+
+class SharedCache(TLRUCache):
+    """
+    Local cache of a single process, backed by the cache server that is shared by all the processes:
+    1. Getting and setting items uses only the local values, so the lock that guards the local
+        values is never held during calls to the cache server
+    2. get_many_shared and set_many_shared look up and add many keys in the cache server in a single
+        call, and don't use the local values, so they are called without the lock, see
+        shared_cached
+    3. Empty values are kept for negative_ttl seconds, which should be shorter than the ttl of the
+        other values, so searches that found nothing are repeated sooner
+    4. If snapshot is set, the local values are loaded from a snapshot file when the cache is first
+        used, and saved to it when the process exits, so a restarted process doesn't start cold
+    """
+
+    def __init__(self, name, maxsize, ttl, negative_ttl, snapshot=False, snapshot_file=None):
+        super().__init__(maxsize, self._get_expiration, timer=time.time)
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.snapshot = snapshot
+        self._snapshot_file = snapshot_file
+        self._snapshot_loaded = False
+        self._expirations = {}
+        self._restored_expirations = {}
+
+    @property
+    def snapshot_file(self):
+        if self._snapshot_file is None:
+            self._snapshot_file = os.path.join(config.get_util_dir(), f"{self.name}_cache.pickle")
+        return self._snapshot_file
+
+    def __getitem__(self, key):
+        self._use_snapshot()
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._use_snapshot()
+        return super().__contains__(key)
+
+    def __setitem__(self, key, value):
+        self._use_snapshot()
+        super().__setitem__(key, value)
+
+    def get_many_shared(self, keys):
+        """
+        Get the values of the keys from the cache server in a single call
+        :type keys: iterable
+        :rtype: dict
+        """
+        keys_by_name = {self._get_key_name(key): key for key in keys}
+        with document_exception(f"Failed to get {len(keys_by_name)} keys from cache server"):
+            return {keys_by_name[key_name]: value
+                    for key_name, value in get_many(keys_by_name).items()}
+        return {}
+
+    def set_many_shared(self, items):
+        """
+        Add the values to the cache server, with a single call for each ttl
+        :type items: dict
+        """
+        items_by_ttl = {}
+        for key, value in items.items():
+            items_by_ttl.setdefault(self._get_days_to_keep(value), {})[
+                self._get_key_name(key)] = value
+        with document_exception(f"Failed to add {len(items)} keys to cache server"):
+            for days_to_keep, ttl_items in items_by_ttl.items():
+                set_many(ttl_items, days_to_keep=days_to_keep)
+
+    def _get_days_to_keep(self, value):
+        return (self.ttl if value else self.negative_ttl) / (24 * 60 * 60)
+
+    def _use_snapshot(self):
+        """
+        Load the snapshot on the first use of the cache and save it when the process exits
+        """
+        if not self.snapshot or self._snapshot_loaded:
+            return
+        self._snapshot_loaded = True
+        self.load_snapshot()
+        atexit.register(self.save_snapshot)
+
+    def _get_key_name(self, key):
+        return f"{self.name}_{hashlib.sha1(repr(key).encode()).hexdigest()}"
+
+    def _get_expiration(self, key, value, now):
+        expiration = self._restored_expirations.pop(key, None)
+        if expiration is None:
+            expiration = now + (self.ttl if value else self.negative_ttl)
+        if len(self._expirations) > 2 * self.maxsize:
+            self._expirations = {key: self._expirations[key] for key in self}
+        self._expirations[key] = expiration
+        return expiration
+
+    def save_snapshot(self):
+        """
+        Save the values that haven't expired yet, with their expiration time, to the snapshot file
+        """
+        with document_exception(f"Failed to save {self.name} cache snapshot"):
+            self.expire()
+            snapshot = {key: (value, self._expirations[key]) for key, value in self.items()}
+            temp_file = f"{self.snapshot_file}.{os.getpid()}"
+            with open(temp_file, 'wb') as snapshot_file:
+                pickle.dump(snapshot, snapshot_file)
+            os.replace(temp_file, self.snapshot_file)
+            log.info(f"Saved {len(snapshot)} entries of {self.name} cache")
+
+    def load_snapshot(self):
+        """
+        Load the values of the snapshot file that haven't expired yet, keeping their original
+        expiration time
+        """
+        if not os.path.exists(self.snapshot_file):
+            return
+        with document_exception(f"Failed to load {self.name} cache snapshot"):
+            with open(self.snapshot_file, 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+            now = time.time()
+            for key, (value, expiration) in snapshot.items():
+                if expiration > now:
+                    self._restored_expirations[key] = expiration
+                    TLRUCache.__setitem__(self, key, value)
+            log.info(f"Loaded {len(self)} entries of {self.name} cache")
+
+
+def shared_cached(cache, lock):
+    """
+    Same as cachetools.cached for SharedCache, but the lock is held only while the local values
+    are used, and not during calls to the cache server:
+    1. Return the local value of the arguments if it's kept
+    2. Otherwise, get the value from the cache server, or call the function and add its result
+        to the cache server
+    3. Keep the value locally
+    :type cache: SharedCache
+    :type lock: threading.RLock
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = hashkey(*args, **kwargs)
+            with lock:
+                try:
+                    return cache[key]
+                except KeyError:
+                    pass
+            shared_values = cache.get_many_shared([key])
+            if key in shared_values:
+                value = shared_values[key]
+            else:
+                value = func(*args, **kwargs)
+                cache.set_many_shared({key: value})
+            with lock:
+                cache[key] = value
+            return value
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,97 @@
+import pickle
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Encoded values start with the magic, that can't start a pickle, followed by the compression id.
+# Values without the magic were saved by older clients, using plain pickle
+MAGIC = b"\x00UC"
+
+NO_COMPRESSION = 0
+ZLIB = 1
+ZSTD = 2
+LZ4 = 3
+
+COMPRESSION_IDS = {"zlib": ZLIB, "zstd": ZSTD, "lz4": LZ4}
+
+DEFAULT_THRESHOLD = 16 * 1024
+
+# Pickle protocol of the items of lists that are appended by the cache client and the cache server,
+# that must be the same in both, since list items are compared by their pickled value
+LIST_ITEM_PROTOCOL = 4
+
+
+def _get_compressors():
+    compressors = {ZLIB: (lambda data: zlib.compress(data, 1), zlib.decompress)}
+    if zstandard:
+        compressors[ZSTD] = (zstandard.ZstdCompressor(level=3).compress,
+                             zstandard.ZstdDecompressor().decompress)
+    if lz4:
+        compressors[LZ4] = (lz4.frame.compress, lz4.frame.decompress)
+    return compressors
+
+
+COMPRESSORS = _get_compressors()
+
+
+def encode(data, compression="zlib", threshold=DEFAULT_THRESHOLD):
+    """
+    1. Pickle the object with the latest protocol, keeping large buffers (e.g. numpy arrays)
+        out-of-band, so they are copied as is instead of being serialized into the pickle
+    2. Frame the pickle and the buffers with their lengths
+    3. If the frame is larger than the threshold, compress it with the requested compression, or
+        with zlib if its library isn't installed
+    4. Prefix the frame with the magic and the compression id, so decode knows how to read it
+    :type data: object
+    :type compression: str
+    :type threshold: int
+    :rtype: bytes
+    """
+    buffers = []
+    pickled_object = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL,
+                                  buffer_callback=buffers.append)
+    raw_buffers = [buffer.raw() for buffer in buffers]
+    frame = b''.join([struct.pack(f"<I{len(raw_buffers) + 1}Q", len(raw_buffers),
+                                  len(pickled_object), *map(len, raw_buffers)),
+                      pickled_object, *raw_buffers])
+    compression_id = NO_COMPRESSION
+    if compression and len(frame) > threshold:
+        compression_id = COMPRESSION_IDS[compression]
+        if compression_id not in COMPRESSORS:
+            compression_id = ZLIB
+        frame = COMPRESSORS[compression_id][0](frame)
+    return MAGIC + bytes([compression_id]) + frame
+
+
+def decode(encoded_data):
+    """
+    Decode value that was encoded by encode, or unpickle value that was saved by older clients
+    :type encoded_data: bytes
+    :rtype: object
+    """
+    if not encoded_data.startswith(MAGIC):
+        return pickle.loads(encoded_data)
+    compression_id = encoded_data[len(MAGIC)]
+    frame = memoryview(encoded_data)[len(MAGIC) + 1:]
+    if compression_id != NO_COMPRESSION:
+        if compression_id not in COMPRESSORS:
+            raise ValueError(f"Value is compressed by compression {compression_id}, "
+                             f"that isn't installed")
+        frame = memoryview(COMPRESSORS[compression_id][1](frame))
+    buffers_count, = struct.unpack_from("<I", frame)
+    lengths = struct.unpack_from(f"<{buffers_count + 1}Q", frame, 4)
+    offset = 4 + 8 * len(lengths)
+    parts = []
+    for length in lengths:
+        parts.append(frame[offset:offset + length])
+        offset += length
+    return pickle.loads(parts[0], buffers=[bytearray(buffer) for buffer in parts[1:]])
@@ -1,3 +1,4 @@
+import pickle
 import sys
 from datetime import timedelta
 
@@ -6,51 +7,217 @@ import rpyc
 from logbook import Logger, StreamHandler
 from rpyc.utils.server import ThreadedServer
 
+from cache_codec import decode, LIST_ITEM_PROTOCOL
+
 REDIS_PORT = 6378
 log = Logger(__name__)
 
+GENERATION_COUNTER = "cache_generation"
+
+# Every write of a key stamps it with a new value of the global generation counter, that is kept in
+# the generation key of the key, with the same expiration. Since the counter is never reset, key
+# that was deleted and written again never gets the same generation
+SET_SCRIPT = """
+local generation = redis.call('INCR', KEYS[3])
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    redis.call('SET', KEYS[2], generation, 'PX', ARGV[2])
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+    redis.call('SET', KEYS[2], generation)
+end
+return generation
+"""
+
+GET_SCRIPT = """
+local key_type = redis.call('TYPE', KEYS[1]).ok
+if key_type == 'none' then
+    return false
+end
+local generation = redis.call('GET', KEYS[2])
+if generation and generation == ARGV[1] then
+    return {generation}
+end
+local value
+if key_type == 'string' then
+    value = redis.call('GET', KEYS[1])
+elseif key_type == 'list' then
+    value = redis.call('LRANGE', KEYS[1], 0, -1)
+elseif key_type == 'set' then
+    value = redis.call('SRANDMEMBER', KEYS[1])
+else
+    return false
+end
+return {generation, value}
+"""
+
+APPEND_SCRIPT = """
+local key_type = redis.call('TYPE', KEYS[1]).ok
+if key_type ~= 'none' and key_type ~= 'list' then
+    return -1
+end
+for _, item in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if item == ARGV[1] then
+        return 0
+    end
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], redis.call('INCR', KEYS[3]))
+return 1
+"""
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
 
 class CacheServer(rpyc.Service):
     def __init__(self, *args):
         self.r_server = redis.Redis()
+        self._set_script = self.r_server.register_script(SET_SCRIPT)
+        self._get_script = self.r_server.register_script(GET_SCRIPT)
+        self._append_script = self.r_server.register_script(APPEND_SCRIPT)
+        self._release_lock_script = self.r_server.register_script(RELEASE_LOCK_SCRIPT)
 
     def on_connect(self, *_):
         log.info("Remote connection accepted")
 
     def exposed_add_to_cache(self, key_name, data, days_to_keep=None):
         """
-        If overwrite data is enabled, add the key to cache
-        if overwrite data is False, check whether the key
+        Set the key to the given data with a single script call, overwriting the previous value and
+        its expiration, whatever its type was, and stamp it with a new generation
         :type key_name: str
         :type data: bytes
-        :type days_to_keep: int
-        :type overwrite: bool
+        :type days_to_keep: Union(int, float)
+        :rtype: int
         """
-        if self.r_server.exists(key_name):
-            log.info(f"Key {key_name} already exists, overwriting it with new value")
-            self.r_server.delete(key_name)
-            self.r_server.sadd(key_name, data)
-        else:
-            self.r_server.sadd(key_name, data)
-            log.info(f"Key {key_name} was added to the cache")
+        generation = self._set(key_name, data, days_to_keep)
+        log.info(f"Key {key_name} was added to the cache, days to keep: {days_to_keep}")
+        return generation
 
-        if days_to_keep:
-            log.info(f"Updating days to keep data for {key_name} to {days_to_keep} days")
-            self.r_server.expire(key_name, timedelta(days=days_to_keep))
+    def _set(self, key_name, data, days_to_keep, client=None):
+        expiration = max(int(timedelta(days=days_to_keep).total_seconds() * 1000), 1) \
+            if days_to_keep else 0
+        return self._set_script(keys=[key_name, _get_generation_key(key_name), GENERATION_COUNTER],
+                                args=[data, expiration], client=client)
 
     def exposed_get_from_cache(self, key_name):
         """
-        1. Check if key is found in cache
-        2. To return the bytes object and not the set that is return by the redis, convert the data
-            to list and return its first member
+        Get the value of the key with a single script call:
+        1. Values that were added by add_to_cache are returned as bytes
+        2. Lists that were created by append_to_list are returned as tuple of the pickled items
+        3. Values of older servers, that were kept as a set with a single member, are returned as
+            bytes as well
+        :type key_name: str
+        :rtype: Union(bytes, tuple)
+        """
+        result = self.exposed_get_if_changed(key_name, None)
+        return result[1] if result else None
+
+    def exposed_get_if_changed(self, key_name, generation):
+        """
+        Get the generation and the value of the key, like get_from_cache. If the generation of the
+        key is still the given generation, return only the generation, so the value isn't
+        transferred again
         :type key_name: str
-        :rtype: bytes
+        :type generation: int
+        :rtype: tuple
         """
         log.info(f"Looking for objects matching {key_name}")
-        if self.r_server.exists(key_name):
-            log.info(f'Matching entry to {key_name} was found')
-            return list(self.r_server.smembers(key_name))[0]
-        log.info(f"Could not find {key_name}")
+        result = self._get_script(keys=[key_name, _get_generation_key(key_name)],
+                                  args=['' if generation is None else generation])
+        if result is None:
+            log.info(f"Could not find {key_name}")
+            return None
+        current_generation = int(result[0]) if result[0] is not None else None
+        if len(result) == 1:
+            log.info(f"Entry of {key_name} wasn't changed")
+            return current_generation,
+        log.info(f'Matching entry to {key_name} was found')
+        value = tuple(result[1]) if isinstance(result[1], list) else result[1]
+        return current_generation, value
+
+    def exposed_get_many(self, key_names):
+        """
+        Get the values of all the keys with a single MGET. Only values that were added by
+        add_to_cache or set_many are returned, missing keys and keys of other types return None
+        :type key_names: tuple
+        :rtype: tuple
+        """
+        log.info(f"Looking for {len(key_names)} keys")
+        return tuple(self.r_server.mget(key_names)) if key_names else ()
+
+    def exposed_set_many(self, items, days_to_keep=None):
+        """
+        Set all the keys to their data in a single pipeline, stamping each of them with a new
+        generation
+        :type items: tuple(tuple(str, bytes))
+        :type days_to_keep: Union(int, float)
+        """
+        with self.r_server.pipeline(transaction=False) as pipeline:
+            for key_name, data in items:
+                self._set(key_name, data, days_to_keep, client=pipeline)
+            pipeline.execute()
+        log.info(f"{len(items)} keys were added to the cache, days to keep: {days_to_keep}")
+
+    def exposed_append_to_list(self, key_name, item):
+        """
+        1. Atomically append the pickled item to the list of the key, unless it's already in the
+            list. The list is created if the key doesn't exist
+        2. If the key holds a pickled list of older clients, convert it to a list of pickled items
+            and try again
+        :type key_name: str
+        :type item: bytes
+        :rtype: bool
+        """
+        keys = [key_name, _get_generation_key(key_name), GENERATION_COUNTER]
+        result = self._append_script(keys=keys, args=[item])
+        if result == -1:
+            self._convert_to_list(key_name)
+            result = self._append_script(keys=keys, args=[item])
+        log.info(f"Item was {'added' if result == 1 else 'already found'} in {key_name}")
+        return result == 1
+
+    def exposed_acquire_lock(self, lock_name, token, timeout):
+        """
+        Acquire the lock for the given token, unless it's already held. The lock is released
+        automatically after timeout seconds, in case its holder died
+        :type lock_name: str
+        :type token: str
+        :type timeout: int
+        :rtype: bool
+        """
+        return bool(self.r_server.set(_get_lock_key(lock_name), token, nx=True,
+                                      px=int(timeout * 1000)))
+
+    def exposed_release_lock(self, lock_name, token):
+        """
+        Release the lock, only if it's still held by the given token
+        :type lock_name: str
+        :type token: str
+        :rtype: bool
+        """
+        return bool(self._release_lock_script(keys=[_get_lock_key(lock_name)], args=[token]))
+
+    def _convert_to_list(self, key_name):
+        log.info(f"Converting {key_name} to list")
+        items = decode(self.exposed_get_from_cache(key_name))
+        with self.r_server.pipeline() as pipeline:
+            pipeline.delete(key_name)
+            pipeline.rpush(key_name, *[pickle.dumps(item, protocol=LIST_ITEM_PROTOCOL)
+                                       for item in items])
+            pipeline.execute()
+
+
+def _get_generation_key(key_name):
+    return f"generation:{key_name}"
+
+
+def _get_lock_key(lock_name):
+    return f"lock:{lock_name}"
 
 
 if __name__ == "__main__":
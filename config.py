@@ -52,14 +52,88 @@ table_footer = "</table>"
 
 cache_server = namedtuple('cacheserver', ['url', 'port'])( "yaelm-freddy.lab.gdc.il.infinidat.com", 6378)
 
+cache_pool_size = 20
+
+cache_timeout = 30
+
+cache_health_check_interval = 60
+
+cache_retry_interval = 60
+
+# The memory of unpickled objects is estimated as their (possibly compressed) pickled size times
+# the factor, since python objects take several times the size of their pickle
+local_cache_max_bytes = 256 * 1024 * 1024
+
+local_cache_size_factor = 8
+
+# Values larger than the threshold are compressed. zstandard and lz4 aren't in the requirements,
+# so "zstd" or "lz4" should be used only if all the processes that read the cache have them
+cache_compression = "zlib"
+
+cache_compression_threshold = 16 * 1024
+
+cache_lock_timeout = 60 * 10
+
+cache_lock_poll_interval = 1
+
 elastic_server_url = 'http://infra-elastic-search.lab.gdc.il.infinidat.com:9200/backslash/_search'
 
-page_scroll_format = "?scroll={}m"
+elastic_scroll_url = 'http://infra-elastic-search.lab.gdc.il.infinidat.com:9200/_search/scroll'
+
+scroll_keep_alive = "2m"
+
+coverage_search_slices = 4
+
+slice_queue_pages = 4
+
+elastic_pool_size = 10
+
+elastic_max_retries = 3
+
+elastic_retry_backoff = 1
+
+elastic_timeout = 300
+
+elastic_compress_requests = True
 
 default_params = (('size', '10000'),)
 
 headers = {'Content-Type': 'application/json'}
 
+test_source_fields = ["status", "logical_id", "test.name", "test.file_name", "parameters",
+                      "errors.message", "subjects.version", "subjects.name", "start_time",
+                      "end_time", "user_email", "scm_local_branch", "session_metadata.Project",
+                      "session_metadata.infinitest-version", "session_metadata.slash::commandline"]
+
+coverage_source_fields = ["status", "logical_id", "test.name", "test.file_name", "start_time",
+                          "updated_at"]
+
+error_type_field = "errors.exception_type"
+
+aggregation_page_size = 1000
+
+partition_days_cache = True
+
+partition_close_delay = 60 * 60
+
+closed_partition_days_to_keep = None
+
+use_tests_mirror = False
+
+tests_mirror_file = "tests_mirror.sqlite"
+
+mirror_initial_days = 30
+
+mirror_watermark_overlap = 10 * 60
+
+mirror_source_fields = test_source_fields + ["updated_at", "session_metadata.Build URL"]
+
+test_params_cache_size = 10000
+
+coverage_state_days_to_keep = 60
+
+coverage_watermark_overlap = 10 * 60
+
 max_error_length = 50
 
 failed_statuses = ["ERROR", "FAILURE"]
@@ -85,6 +159,47 @@ jira_query = 'updated > -365d' \
              ' and (project = "Infinibox Tests" or' \
              ' project = InfiniBox or project = "Infrastructure Development")'
 
+jira_batch_query = 'updated > -365d' \
+                   ' and resolution not in (Duplicate,  "Not a Bug", "Idea Rejected")' \
+                   ' and ({0})' \
+                   ' and (project = "Infinibox Tests" or' \
+                   ' project = InfiniBox or project = "Infrastructure Development")'
+
+jira_text_condition = 'text ~ "{0}"'
+
+jira_max_query_length = 6000
+
+jira_max_strings_per_query = 30
+
+# The maximal number of tickets that a single jira search returns. Searches that return that many
+# tickets may be truncated
+jira_max_results = 50
+
+use_jira_store = False
+
+jira_store_file = "jira_store.sqlite"
+
+jira_store_query = 'updated > -365d and updated >= "{0}"' \
+                   ' and (project = "Infinibox Tests" or' \
+                   ' project = InfiniBox or project = "Infrastructure Development")' \
+                   ' order by updated asc'
+
+jira_store_days = 365
+
+jira_store_sync_overlap = 24 * 60 * 60
+
+jira_excluded_resolutions = ["Duplicate", "Not a Bug", "Idea Rejected"]
+
+jira_cache_size = 40000
+
+jira_cache_ttl = 60 * 60 * 2
+
+jira_negative_cache_ttl = 60 * 15
+
+jira_batch_size = 100
+
+jira_max_workers = 8
+
 jira_link = '<a href="https://jira.infinidat.com/browse/{0}">{0}</a>'
 jira_link_status = '<a href="https://jira.infinidat.com/browse/{0}">{0} - {1}</a>'
 
@@ -94,6 +209,7 @@ tests_search_link = '<a href="https://backslash.infinidat.com/#/tests?search={0}
 
 webui_menus_index = {"Queries": ["obtain_all_test_errors",
                                  "test_stats",
+                                 "errors_histogram",
                                  "get_failed_tests_by_name",
                                  "find_test_by_error"],
                      "Reports": ["coverage_reports",
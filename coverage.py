@@ -1,66 +1,181 @@
+from collections import namedtuple
+from itertools import chain
+
 import arrow
+import numpy as np
 
 import config
 import log
-from elastic_search_queries import process_error
+from cache_client import get_from_cache, add_to_cache
+from elastic_search_queries import ElasticSearch
+from tests_mirror import TestsMirror
+
+Execution = namedtuple('Execution', 'status start_time test_module test_name')
+FlakyTests = namedtuple('FlakyTests', 'executed_tests flaky_tests')
 
 
-def determine_flaky_tests(executed_tests, all_repo_tests):
+class RepoTestsIndex(object):
+    """
+    Resolve the repo test keys that contain both the module and the name of an executed test,
+    exactly as checking each key with `in`, without going over all the keys for every execution:
+    1. Keys are grouped by their file path, so a module is only matched against the paths. Module
+        with "/" and without ":" can only be found in the path part of the key
+    2. Other modules fall back to checking all the keys
+    3. The resolved keys are memoized per (module, name), since the same test is executed many
+        times. The keys are returned by their order in the repo tests
+    """
+
+    def __init__(self, repo_tests):
+        self._positions = {test_key: index for index, test_key in enumerate(repo_tests)}
+        self._keys_by_path = {}
+        for test_key in repo_tests:
+            self._keys_by_path.setdefault(test_key.split(':', 1)[0], []).append(test_key)
+        self._paths_by_module = {}
+        self._resolved_keys = {}
+
+    def resolve(self, test_module, test_name):
+        """
+        :type test_module: str
+        :type test_name: str
+        :rtype: list
+        """
+        test = (test_module, test_name)
+        if test not in self._resolved_keys:
+            self._resolved_keys[test] = self._match(test_module, test_name)
+        return self._resolved_keys[test]
+
+    def _match(self, test_module, test_name):
+        if '/' in test_module and ':' not in test_module:
+            candidates = [test_key for path in self._get_paths(test_module)
+                          for test_key in self._keys_by_path[path]]
+        else:
+            candidates = self._positions
+        return sorted([test_key for test_key in candidates
+                       if test_name in test_key and test_module in test_key],
+                      key=self._positions.get)
+
+    def _get_paths(self, test_module):
+        if test_module not in self._paths_by_module:
+            self._paths_by_module[test_module] = [path for path in self._keys_by_path
+                                                  if test_module in path]
+        return self._paths_by_module[test_module]
+
+
+def classify_flaky_tests(executed_tests, all_repo_tests):
     """
     1. Determine flaky tests by getting tests that both failed and succeeded
-    2. Iterate through flaky tests
-    2.1 If test latest executions succeeded or failed config.runs_threshold times
-        (including the params), the test will be considered 10_successful/failed
+    2. For all the flaky tests at once, count the latest executions of each status that are newer
+        than the latest execution of the other status. Every len(repo tests) executions (the test
+        params) are counted as a single definite run
+    2.1 If test latest executions succeeded or failed config.definite_executions_threshold times,
+        the test will be considered Last_<threshold>_SUCCESS/ERROR, success is checked first
     2.2 Otherwise, tests will be considered flaky
+    3. Return new executed tests, without the flaky tests in SUCCESS and ERROR, and the flaky tests.
+        The given executed tests are not changed
     :type executed_tests: dict
     :type all_repo_tests: dict
-    :rtype: list
+    :rtype: FlakyTests
     """
+    threshold = config.definite_executions_threshold
+    success_tests = executed_tests['SUCCESS']
+    error_tests = executed_tests['ERROR']
+    flaky_keys = [test_key for test_key in success_tests if test_key in error_tests]
+    counts = {test_key: {"SUCCESS": len(success_tests[test_key]),
+                         "FAILURE": len(error_tests[test_key])} for test_key in flaky_keys}
+    num_tests = np.array([len(all_repo_tests[test_key]) for test_key in flaky_keys], dtype=np.int64)
+    definite_success = _count_newer_executions(success_tests, error_tests, flaky_keys) // \
+        np.maximum(num_tests, 1) >= threshold
+    definite_error = ~definite_success & (
+        _count_newer_executions(error_tests, success_tests, flaky_keys) //
+        np.maximum(num_tests, 1) >= threshold)
+    flaky_keys_set = set(flaky_keys)
+    classified_tests = {
+        "SUCCESS": {test_key: times for test_key, times in success_tests.items()
+                    if test_key not in flaky_keys_set},
+        "ERROR": {test_key: times for test_key, times in error_tests.items()
+                  if test_key not in flaky_keys_set},
+        f"Last_{threshold}_SUCCESS": {test_key: counts[test_key] for test_key, definite in
+                                      zip(flaky_keys, definite_success) if definite},
+        f"Last_{threshold}_ERROR": {test_key: counts[test_key] for test_key, definite in
+                                    zip(flaky_keys, definite_error) if definite}}
+    flaky_tests = {test_key: counts[test_key] for test_key, success, error in
+                   zip(flaky_keys, definite_success, definite_error) if not success and not error}
+    log.info(f"{len(flaky_tests)} tests will be considered flaky, "
+             f"{len(classified_tests[f'Last_{threshold}_SUCCESS'])} ended with SUCCESS and "
+             f"{len(classified_tests[f'Last_{threshold}_ERROR'])} ended with ERROR "
+             f"{threshold} times")
+    return FlakyTests(classified_tests, flaky_tests)
+
 
-    def get_num_definite_runs(tested_status, static_status):
-        num_of_definite_executions = 0
-        last_test = arrow.get(executed_tests[static_status][flaky_test][0], 'DD-MM-YY HH:mm:ss')
-        for index, success_time in enumerate(executed_tests[tested_status][flaky_test]):
-            if arrow.get(success_time, 'DD-MM-YY HH:mm:ss') > last_test:
-                if (index + 1) % num_tests == 0:
-                    num_of_definite_executions += 1
-            else:
-                break
-        if num_of_definite_executions >= config.definite_executions_threshold:
-            log.info(
-                f"{flaky_test} has ended with {tested_status}"
-                f" {config.definite_executions_threshold} times")
-            executed_tests[f"Last_{config.definite_executions_threshold}_{tested_status}"][
-                flaky_test] = {"SUCCESS": len(executed_tests["SUCCESS"][flaky_test]),
-                               "FAILURE": len(executed_tests["ERROR"][flaky_test])}
-            del(executed_tests[static_status][flaky_test])
-            del(executed_tests[tested_status][flaky_test])
-            updated_flaky_tests.pop(flaky_test)
-            return True
-
-    flaky_tests = set([test_name for test_name in executed_tests['SUCCESS']]) & set(
-        [test_name for test_name in executed_tests['ERROR']])
-    updated_flaky_tests = {flaky_test: {'SUCCESS': len(executed_tests['SUCCESS'][flaky_test]),
-                                        "FAILURE": len(executed_tests['ERROR'][flaky_test])}
-                           for flaky_test in flaky_tests}
-    for flaky_test in flaky_tests:
-        num_tests = len(all_repo_tests[flaky_test])
-        status_updated = get_num_definite_runs('SUCCESS', 'ERROR')
-        if not status_updated:
-            status_updated = get_num_definite_runs('ERROR', 'SUCCESS')
-
-        if not status_updated:
-            log.info(f"{flaky_test} will be considered Flaky")
-            del (executed_tests['SUCCESS'][flaky_test])
-            del (executed_tests['ERROR'][flaky_test])
-    return updated_flaky_tests
-
-
-def update_errors(test, errors):
-    if test._status == "ERROR":
-        for error in test._errors:
-            processed_error = process_error(error, max_length=70)
-            if processed_error in errors:
-                errors[processed_error] += 1
-            else:
-                errors[processed_error] = 1
+def _count_newer_executions(tested_tests, static_tests, test_keys):
+    """
+    For each test key, count the leading executions in the tested status that are newer than the
+    first execution in the static status
+    :type tested_tests: dict
+    :type static_tests: dict
+    :type test_keys: list
+    :rtype: numpy.ndarray
+    """
+    lengths = np.array([len(tested_tests[test_key]) for test_key in test_keys], dtype=np.int64)
+    start_times = np.fromiter(chain.from_iterable(tested_tests[test_key] for test_key in test_keys),
+                              dtype=np.float64, count=int(lengths.sum()))
+    last_static = np.array([static_tests[test_key][0] for test_key in test_keys], dtype=np.float64)
+    owners = np.repeat(np.arange(len(test_keys)), lengths)
+    positions = np.arange(len(start_times)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    older = start_times <= last_static[owners]
+    first_older = lengths.copy()
+    np.minimum.at(first_older, owners[older], positions[older])
+    return first_older
+
+
+def get_version_errors(version, include_simulator):
+    """
+    Count the errors of the tests that ended with ERROR on the given version. The errors are
+    aggregated on the server, so the tests themselves are not transferred
+    :type version: str
+    :type include_simulator: bool
+    :rtype: dict
+    """
+    return ElasticSearch().get_error_counts(max_length=70, version=version,
+                                            include_simulator=include_simulator,
+                                            status=["ERROR"], coverage=True)
+
+
+def get_version_executions(version, include_simulator):
+    """
+    1. Load the executions of the version that were already fetched from the cache
+    2. Fetch only the tests that were updated since the last fetch and merge them in, replacing
+        the previous copy of tests that were updated
+    3. Save the merged executions with the latest update time, slightly moved back to include tests
+        that were indexed late, for the next fetch
+    4. Return the executions in the same order they are returned by the elastic search
+    The tests are read from the tests mirror instead of the elastic search if
+    config.use_tests_mirror is set
+    :type version: str
+    :type include_simulator: bool
+    :rtype: list(Execution)
+    """
+    state_key = f"coverage_state_{version}_{include_simulator}"
+    cached_state = get_from_cache(state_key) or {"watermark": None, "executions": {}}
+    # The cached state may be shared with other callers, so it's copied before it's modified
+    state = {"watermark": cached_state['watermark'],
+             "executions": dict(cached_state['executions'])}
+    log.info(f"Fetching tests of version {version} that were updated since "
+             f"{arrow.get(state['watermark']) if state['watermark'] else 'ever'}")
+    latest_update = state['watermark']
+    tests_source = TestsMirror() if config.use_tests_mirror else ElasticSearch()
+    tests = tests_source.iter_test_results(version=version, include_simulator=include_simulator,
+                                           status=config.all_statuses, coverage=True,
+                                           slices=config.coverage_search_slices,
+                                           updated_after=state['watermark'])
+    for test in tests:
+        test_data = test['_source']
+        state['executions'][test['_id']] = Execution(test_data['status'], test_data['start_time'],
+                                                     test_data['test']['file_name'],
+                                                     test_data['test']['name'])
+        updated_at = arrow.get(test_data['updated_at']).float_timestamp - \
+            config.coverage_watermark_overlap
+        latest_update = updated_at if latest_update is None else max(latest_update, updated_at)
+    state['watermark'] = latest_update
+    add_to_cache(state_key, state, days_to_keep=config.coverage_state_days_to_keep)
+    return [execution for _, execution in sorted(state['executions'].items(), reverse=True)]
@@ -1,46 +1,108 @@
 import ast
+import json
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from queue import Queue, Full
 
 import arrow
-import requests
+from requests import HTTPError
 
 import config
 import log
-from jira_queries import get_jira_tickets
+from elastic_transport import get_transport
+from exceptions import document_exception
+from query_cache import iter_partitioned_results
 
 
 class InternalTest(object):
+    """
+    Compact representation of a backslash test. Only the raw values are kept, the display values
+    (links, formatted times etc.) are computed when they are accessed
+    """
+    __slots__ = ('_status', '_id', 'test_name', 'test_module', 'parameters', 'version', 'system',
+                 'branch', '_start_time', '_duration', '_user_email', '_errors', '_related_tickets',
+                 'related_tickets')
+    display_fields = ('test_link', 'test_name', 'test_module', 'parameters', 'first_error',
+                      'version', 'system', 'start_time', 'duration', 'user_name', 'branch')
+
     def __init__(self, backslash_test, test_params, jira_tickets):
         test_data = backslash_test['_source']
+        subject = test_data['subjects'][0] if test_data.get('subjects') else {}
+        end_time = test_data.get('end_time') or test_data['start_time']
         self._status = test_data['status']
         self._id = test_data["logical_id"]
-        self.test_link = config.test_link.format(self._id)
         self.test_name = test_data['test']['name']
         self.test_module = test_data['test']['file_name']
         self.parameters = _get_test_params(test_params, test_data)
-        self.first_error = _truncate_text(test_data['errors'][0]['message'], 120) if test_data[
-            'errors'] else ''
-        self.version = test_data['subjects'][0]['version']
-        self.system = test_data['subjects'][0]['name']
-        self.start_time = arrow.get(test_data['start_time']).format('DD-MM-YY HH:mm:ss')
-        self.duration = arrow.get(
-            arrow.get(test_data['end_time'] - test_data['start_time'])).format('HH:mm:ss')
-        self._duration = test_data['end_time'] - test_data['start_time']
-        self.user_name = test_data['user_email'].split('@')[0]
-        self.branch = test_data['scm_local_branch'] if test_data['scm_local_branch'] else ''
-        self._errors = test_data['errors'] if test_data['errors'] else []
+        self.version = subject.get('version', '')
+        self.system = subject.get('name', '')
+        self.branch = test_data['scm_local_branch'] if test_data.get('scm_local_branch') else ''
+        self._start_time = test_data['start_time']
+        self._duration = end_time - test_data['start_time']
+        self._user_email = test_data.get('user_email', '')
+        self._errors = test_data['errors'] if test_data.get('errors') else []
+        self._related_tickets = None
+        self.related_tickets = None
         if jira_tickets:
             self._related_tickets = []
             self.related_tickets = ''
-            get_jira_tickets(self)
+
+    @property
+    def test_link(self):
+        return config.test_link.format(self._id)
+
+    @property
+    def first_error(self):
+        return _truncate_text(self._errors[0]['message'], 120) if self._errors else ''
+
+    @property
+    def start_time(self):
+        return arrow.get(self._start_time).format('DD-MM-YY HH:mm:ss')
+
+    @property
+    def duration(self):
+        return arrow.get(arrow.get(self._duration)).format('HH:mm:ss')
+
+    @property
+    def user_name(self):
+        return self._user_email.split('@')[0]
+
+    def get_display_fields(self):
+        """
+        Return the names of the fields that are displayed in the tests table
+        :rtype: tuple
+        """
+        if self._related_tickets is not None:
+            return self.display_fields + ('related_tickets',)
+        return self.display_fields
+
+    def get_display_values(self):
+        return [getattr(self, field) for field in self.get_display_fields()]
 
 
 def _get_test_params(test_params, test_data):
-    if test_params and test_data['parameters'] and test_data['parameters'] != 'null':
+    if test_params and test_data.get('parameters') and test_data['parameters'] != 'null':
+        return dict(_decode_test_params(test_data['parameters']))
+
+
+@lru_cache(maxsize=config.test_params_cache_size)
+def _decode_test_params(raw_params):
+    """
+    1. Decode the parameters json string, in case it isn't a valid json, evaluate it as python
+        literal
+    2. Return the parameters as (name, str value) pairs. The same parameters repeat in many
+        tests, so the decoded parameters are cached by the raw string
+    :type raw_params: str
+    :rtype: tuple
+    """
+    try:
+        params_dict = json.loads(raw_params)
+    except ValueError:
         params_dict = ast.literal_eval(
-            test_data['parameters'].replace('true', 'True').replace('false', 'False').replace(
-                'null', 'None'))
-        return {key: str(value) for key, value in params_dict.items()}
+            raw_params.replace('true', 'True').replace('false', 'False').replace('null', 'None'))
+    return tuple((key, str(value)) for key, value in params_dict.items())
 
 
 def process_error(error, max_length=config.max_error_length):
@@ -61,11 +123,31 @@ def _truncate_text(exception_type, max_len):
         f"{exception_type[0:max_len]}..."
 
 
+def _get_source_fields(kwargs):
+    """
+    Return the document fields that should be fetched for the query:
+    1. If fields are specified explicitly, use them
+    2. Coverage only requires the test name, file, status, start time and update time
+    3. Otherwise, fetch the fields that are used by InternalTest, without the parameters in case
+        they are not required
+    :type kwargs: dict
+    :rtype: list
+    """
+    if kwargs.get('fields'):
+        return kwargs['fields']
+    if kwargs.get('coverage'):
+        return config.coverage_source_fields
+    if kwargs.get('test_params') is False:
+        return [field for field in config.test_source_fields if field != 'parameters']
+    return config.test_source_fields
+
+
 def get_tests_query(**kwargs):
     """
     1. Validate input,  only the following var names are allowed: test_name, error, days_delta, status
     1. Combine query based on given test name and error
     2. If error is not provided, remove the error sequence from the query dict
+    3. Restrict the returned fields to the ones that are required by the command
     :rtype: dict
     """
     Query = namedtuple('Query', 'operation field')
@@ -88,7 +170,8 @@ def get_tests_query(**kwargs):
                         "query": "KeyboardInterrupt OR bdb.BdbQuit"}},
                     {"range": {"num_interruptions": {"gte": 1}}},
                 ]}},
-        "sort": [{"_id": "desc"}, {"start_time": "asc"}]}
+        "sort": [{"_id": "desc"}, {"start_time": "asc"}],
+        "_source": _get_source_fields(kwargs)}
 
     for query, query_value in supported_keys.items():
         if query in kwargs and kwargs[query] is not None:
@@ -104,9 +187,30 @@ def get_tests_query(**kwargs):
         #tests_query['query']['bool']['must_not'].append({"match": {"subjects.version": "dev"}})
         tests_query['query']['bool']['must'].append({"match": {"session_metadata.Project": "infinibox_tests"}})
         tests_query['query']['bool']['must_not'].append({"prefix": {"test.file_name": "tests/test_utils_tests"}})
+    if kwargs.get('updated_after') is not None:
+        tests_query['query']['bool']['must'].append(
+            {"range": {"updated_at": {"gte": arrow.get(kwargs['updated_after']).isoformat()}}})
     return tests_query
 
 
+def get_aggregation_query(sources, **kwargs):
+    """
+    1. Filter the tests with the tests query, but don't return any of the tests
+    2. Group the tests by the given fields using composite aggregation, so all the buckets can be
+        paged through with after_key
+    :type sources: dict
+    :rtype: dict
+    """
+    aggregation_query = get_tests_query(**kwargs)
+    aggregation_query.pop('sort')
+    aggregation_query.pop('_source')
+    aggregation_query['size'] = 0
+    aggregation_query['aggs'] = {"buckets": {"composite": {
+        "size": config.aggregation_page_size,
+        "sources": [{name: {"terms": {"field": field}}} for name, field in sources.items()]}}}
+    return aggregation_query
+
+
 def get_errors_query(error_message):
     """
     :type error_message: str
@@ -117,48 +221,181 @@ def get_errors_query(error_message):
                                         ]}}}
 
 
+def _put_page(pages_queue, stop_event, page):
+    """
+    Put the page in the queue, waiting while it's full, unless the reader stopped
+    :rtype: bool
+    """
+    while not stop_event.is_set():
+        try:
+            pages_queue.put(page, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _iter_queued_pages(pages_queue, num_of_slices):
+    """
+    Yield the hits of the pages in the queue, until all the slices that write to it are done
+    :type pages_queue: Queue
+    :type num_of_slices: int
+    :rtype: Iterator[dict]
+    """
+    while num_of_slices:
+        page = pages_queue.get()
+        if page is None:
+            num_of_slices -= 1
+        elif isinstance(page, Exception):
+            raise page
+        else:
+            yield from page
+
+
 class ElasticSearch(object):
-    def __init__(self):
+    def __init__(self, transport=None):
         self.url = config.elastic_server_url
         self.params = config.default_params
-        self.headers = config.headers
+        self.transport = transport if transport else get_transport()
+
+    @property
+    def stats(self):
+        return self.transport.stats
 
     def post_query_request(self, query):
+        return list(self.iter_query_results(query))
+
+    def iter_query_results(self, query):
+        """
+        Yield the hits of the given query one by one, as their pages arrive
+        :type query: dict
+        :rtype: Iterator[dict]
+        """
+        for page in self.iter_query_pages(query):
+            yield from page
+
+    def iter_query_pages(self, query):
+        """
+        1. Execute the query and yield the first page of hits
+        2. While there are more results, continue from the last hit using search_after and yield
+            each page as soon as it is received, so only a single page is held in memory at a time
+        :type query: dict
+        :rtype: Iterator[list]
+        """
         results = self._post_request(self.url, query)
         total_results = results['hits']['total']
-
         log.info(f"Found {total_results} results")
-        returned_results = results['hits']['hits']
-        if total_results > len(returned_results):
-            self._search_after_query(query, returned_results, total_results)
-        return returned_results
-
-    def _search_after_query(self, query, returned_results, total_results):
-        query["search_after"] = returned_results[-1]["sort"]
-        while len(returned_results) < total_results:
+        page = results['hits']['hits']
+        yield page
+        if total_results > len(page):
+            yield from self._search_after_query(query, page, total_results)
+
+    def _search_after_query(self, query, first_page, total_results):
+        query["search_after"] = first_page[-1]["sort"]
+        num_of_results = len(first_page)
+        while num_of_results < total_results:
             results = self._post_request(self.url, query)
             new_results = results['hits']['hits']
-            returned_results.extend(new_results)
+            if not new_results:
+                break
+            num_of_results += len(new_results)
             query["search_after"] = new_results[-1]["sort"]
-            log.info(f"{len(returned_results)} out of {total_results}")
+            log.info(f"{num_of_results} out of {total_results}")
+            yield new_results
+
+    def iter_sliced_results(self, query, slices, preserve_order=True):
+        """
+        1. Split the query into independent scroll slices and fetch all of them concurrently. Each
+            slice puts its pages in a bounded queue, so at most config.slice_queue_pages pages of
+            each slice are held in memory, and the slice waits while its queue is full
+        2. If preserve_order is set, yield the slices by their id order, so the same query always
+            returns the hits in the same order. The later slices wait while the earlier slices are
+            read, so it should be used only when the slices are read faster than
+            config.scroll_keep_alive. Otherwise, yield the pages of all the slices as soon as they
+            arrive
+        3. If the iteration is stopped early, stop all the slices, so their scroll contexts are
+            released
+        :type query: dict
+        :type slices: int
+        :type preserve_order: bool
+        :rtype: Iterator[dict]
+        """
+        if slices < 2:
+            yield from self.iter_query_results(query)
+            return
+        log.info(f"Executing query in {slices} parallel slices")
+        if preserve_order:
+            pages_queues = [Queue(maxsize=config.slice_queue_pages) for _ in range(slices)]
+        else:
+            pages_queues = [Queue(maxsize=config.slice_queue_pages * slices)] * slices
+        stop_event = threading.Event()
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            for slice_id in range(slices):
+                executor.submit(self._scroll_slice, query, slice_id, slices,
+                                pages_queues[slice_id], stop_event)
+            try:
+                if preserve_order:
+                    for pages_queue in pages_queues:
+                        yield from _iter_queued_pages(pages_queue, 1)
+                else:
+                    yield from _iter_queued_pages(pages_queues[0], slices)
+            finally:
+                stop_event.set()
 
+    def _scroll_slice(self, query, slice_id, max_slices, pages_queue, stop_event):
+        """
+        1. Open a scroll context for a single slice of the query, sorted by _doc, which is the
+            cheapest order to scroll by
+        2. Keep scrolling until the slice is exhausted or stopped, putting each page in the queue
+        3. Release the scroll context and mark the slice as done by putting None in the queue. If
+            the slice failed, put its exception before, so it's raised by the reader
+        :type query: dict
+        :type slice_id: int
+        :type max_slices: int
+        :type pages_queue: Queue
+        :type stop_event: threading.Event
+        """
+        scroll_id = None
+        try:
+            slice_query = {key: value for key, value in query.items() if key != "search_after"}
+            slice_query["slice"] = {"id": slice_id, "max": max_slices}
+            slice_query["sort"] = ["_doc"]
+            params = self.params + (('scroll', config.scroll_keep_alive),)
+            results = self._post_request(self.url, slice_query, params=params)
+            total_results = results['hits']['total']
+            scroll_id = results.get('_scroll_id')
+            new_results = results['hits']['hits']
+            num_of_results = len(new_results)
+            is_queued = _put_page(pages_queue, stop_event, new_results)
+            while is_queued and new_results and num_of_results < total_results:
+                results = self._post_request(
+                    config.elastic_scroll_url,
+                    {"scroll": config.scroll_keep_alive, "scroll_id": scroll_id}, params=(),
+                    retry=False)
+                scroll_id = results.get('_scroll_id', scroll_id)
+                new_results = results['hits']['hits']
+                num_of_results += len(new_results)
+                log.info(f"Slice {slice_id}: {num_of_results} out of {total_results}")
+                is_queued = _put_page(pages_queue, stop_event, new_results)
+        except Exception as e:
+            _put_page(pages_queue, stop_event, e)
+        finally:
+            if scroll_id:
+                self._clear_scroll(scroll_id)
+            _put_page(pages_queue, stop_event, None)
 
-    def _scroll_pages(self, total_results, returned_results, query):
-        num_of_scrolls = total_results // len(returned_results)
-        if total_results % len(returned_results):
-            num_of_scrolls += 1
-        log.info(f"Number of results requires {num_of_scrolls} scrolls")
-        for scroll_num in range(2, num_of_scrolls):
-            scroll_url = f"{self.url}{config.page_scroll_format.format(scroll_num)}"
-            log.info(f"Scrolling to {scroll_url}")
-            results = self._post_request(scroll_url, query)
-            returned_results.append(results['hits']['hits'])
+    def _clear_scroll(self, scroll_id):
+        with document_exception(f"Failed to clear scroll {scroll_id}"):
+            self.transport.delete(config.elastic_scroll_url, {"scroll_id": [scroll_id]})
 
-    def _post_request(self, url, query):
+    def _post_request(self, url, query, params=None, retry=True):
+        """
+        Searches are retried by default, since the query body (including the search_after cursor)
+        fully defines the returned page. Scroll continuations must pass retry=False
+        """
         log.info(f"Executing query: {query}")
-        response = requests.post(url, params=self.params, headers=self.headers, json=query)
-        response.raise_for_status()
-        return response.json()
+        params = self.params if params is None else params
+        return self.transport.post(url, query, params=params, retry=retry)
 
     def get_test_results(self, **kwargs):
         """
@@ -166,8 +403,75 @@ class ElasticSearch(object):
         2. Execute query
         :rtype: dict
         """
+        return list(self.iter_test_results(**kwargs))
+
+    def iter_test_results(self, **kwargs):
+        """
+        Same as get_test_results, but yields the tests as they are received:
+        1. In case days are specified, the query is executed per day, using the cached results of
+            the days that are already over
+        2. In case slices are specified, the query is split and fetched in parallel slices, and
+            the tests are yielded as they arrive from all the slices, not by the query sort
+        :rtype: Iterator[dict]
+        """
+        if kwargs.get('days') and config.partition_days_cache:
+            tests_query = get_tests_query(
+                **{key: value for key, value in kwargs.items() if key != 'days'})
+            return iter_partitioned_results(self, tests_query, float(kwargs['days']))
         tests_query = get_tests_query(**kwargs)
-        return self.post_query_request(tests_query)
+        if kwargs.get('slices'):
+            return self.iter_sliced_results(tests_query, kwargs['slices'], preserve_order=False)
+        return self.iter_query_results(tests_query)
+
+    def iter_aggregation_pages(self, query):
+        """
+        Yield the results of composite aggregation query, page after page
+        :type query: dict
+        :rtype: Iterator[dict]
+        """
+        while True:
+            results = self._post_request(self.url, query, params=())
+            yield results
+            aggregation = results['aggregations']['buckets']
+            if not aggregation['buckets'] or 'after_key' not in aggregation:
+                break
+            query['aggs']['buckets']['composite']['after'] = aggregation['after_key']
+
+    def get_error_counts(self, max_length=config.max_error_length, **kwargs):
+        """
+        Count the occurrences of each exception type in the queried tests:
+        1. Aggregate the exception types on the server, so none of the tests are transferred
+        2. If the mapping doesn't allow aggregating on the exception type, fall back to counting
+            the errors of the fetched tests. This is the case when the aggregation fails, or when
+            it returns no buckets although tests were matched, which happens when the exception
+            type isn't mapped
+        Like the aggregation, that counts the tests of each exception type, the fallback counts
+        each exception type once per test, so both return the same counts
+        :type max_length: int
+        :rtype: dict
+        """
+        query = get_aggregation_query({"error_type": config.error_type_field}, **kwargs)
+        try:
+            errors = {}
+            total_results = None
+            for results in self.iter_aggregation_pages(query):
+                if total_results is None:
+                    total_results = results['hits']['total']
+                for bucket in results['aggregations']['buckets']['buckets']:
+                    error = process_error({"message": bucket['key']['error_type']}, max_length)
+                    errors[error] = errors.get(error, 0) + bucket['doc_count']
+            if errors or not total_results:
+                return errors
+            log.warning(f"Aggregation on {config.error_type_field} returned no buckets for "
+                        f"{total_results} tests, counting the errors locally")
+        except HTTPError as e:
+            log.warning(f"Could not aggregate errors on the server ({e}), counting them locally")
+        errors = {}
+        for test in self.iter_test_results(**dict(kwargs, fields=["errors.message"])):
+            for processed_error in {process_error(error, max_length)
+                                    for error in test['_source'].get('errors') or []}:
+                errors[processed_error] = errors.get(processed_error, 0) + 1
+        return errors
 
     def get_errors(self, error_message):
         log.info(f"Executing query for error message = {error_message}")
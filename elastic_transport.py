@@ -0,0 +1,130 @@
+import gzip
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import log
+
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class TransportStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self._lock = threading.Lock()
+
+    def add_request(self, latency, bytes_sent, bytes_received):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            self.total_latency += latency
+            self.last_latency = latency
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def __repr__(self):
+        return f"{self.requests} requests ({self.retries} retries), sent {self.bytes_sent} bytes, " \
+               f"received {self.bytes_received} bytes, total latency {self.total_latency:.2f}s"
+
+
+class ElasticTransport(object):
+    """
+    HTTP transport for the elastic search server:
+    1. Keeps a pool of keep-alive connections, shared by all the queries in the process
+    2. Compresses request bodies with gzip and accepts gzip compressed responses
+    3. Retries failed requests with exponential backoff, only if the caller asks for it. Requests
+        that change the state of the server, like scroll continuations, must not be retried, since
+        if the server processed a request whose response was lost, the retry returns the next page
+    """
+
+    def __init__(self, pool_size=config.elastic_pool_size, max_retries=config.elastic_max_retries,
+                 compress=config.elastic_compress_requests):
+        self.max_retries = max_retries
+        self.compress = compress
+        self.stats = TransportStats()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(config.headers)
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+
+    def post(self, url, body, params=(), retry=False):
+        """
+        Send json body to the specified url and return the decoded json response
+        :type url: str
+        :type body: dict
+        :type params: tuple
+        :param retry: retry the request if it fails, should be set only for idempotent requests
+        :rtype: dict
+        """
+        return self._send('POST', url, body, params, retry).json()
+
+    def delete(self, url, body):
+        self._send('DELETE', url, body, (), False)
+
+    def _send(self, method, url, body, params, retry):
+        data = json.dumps(body).encode()
+        headers = {}
+        if self.compress:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        max_retries = self.max_retries if retry else 0
+        for attempt in range(max_retries + 1):
+            start_time = time.monotonic()
+            try:
+                response = self.session.request(method, url, params=params, data=data,
+                                                headers=headers, timeout=config.elastic_timeout)
+                if response.status_code in RETRY_STATUSES and attempt < max_retries:
+                    raise requests.HTTPError(f"Server responded with {response.status_code}",
+                                             response=response)
+                response.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                if attempt == max_retries or not _is_retryable(e):
+                    raise
+                delay = config.elastic_retry_backoff * 2 ** attempt
+                log.warning(f"Request to {url} failed: {e}, retrying in {delay} seconds "
+                            f"({attempt + 1}/{max_retries})")
+                self.stats.add_retry()
+                time.sleep(delay)
+                continue
+            latency = time.monotonic() - start_time
+            bytes_received = int(response.headers.get('Content-Length', len(response.content)))
+            self.stats.add_request(latency, len(data), bytes_received)
+            log.debug(f"{method} {url} took {latency:.2f}s, sent {len(data)} bytes, "
+                      f"received {bytes_received} bytes")
+            return response
+
+
+def _is_retryable(error):
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUSES
+    return True
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Return the transport of the current process, so all queries share the same connection pool
+    :rtype: ElasticTransport
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = ElasticTransport()
+        return _transport
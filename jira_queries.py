@@ -1,63 +1,271 @@
-from cachetools import cached
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, RLock
+
+from cachetools.keys import hashkey
 from ecosystem.jira import client
-from cachetools import TTLCache
 
 import config
 import log
+from cache_client import SharedCache, shared_cached
 from exceptions import document_exception
+from jira_store import JiraStore, StoredTicket
+
 
+cache = SharedCache("jira", maxsize=config.jira_cache_size, ttl=config.jira_cache_ttl,
+                    negative_ttl=config.jira_negative_cache_ttl, snapshot=True)
+cache_lock = RLock()
 
-cache = TTLCache(maxsize=40000, ttl=60 * 60 * 2)
+_jira_store = None
+_jira_store_lock = Lock()
 
 
-@cached(cache)
+@shared_cached(cache, cache_lock)
 def _query_jira(query_string):
-    return [ticket for ticket in client.search(config.jira_query.format(query_string))
-            if query_string in ticket.get_summary() or
-            (ticket.get_field("description") and query_string in ticket.get_field(
-                "description"))]
+    return [StoredTicket.from_ticket(ticket)
+            for ticket in client.search(config.jira_query.format(query_string))
+            if _ticket_contains(ticket, query_string)]
+
+
+def _ticket_contains(ticket, query_string):
+    return query_string in ticket.get_summary() or \
+           (ticket.get_field("description") and query_string in ticket.get_field("description"))
+
+
+def attach_jira_tickets(tests):
+    """
+    1. Collect the query strings (test name, errors and id) of all the tests and remove the
+        duplicates, since the same errors and test names repeat in many tests
+    2. Match all the distinct strings against the local jira store if it's used, otherwise query
+        jira for them, see query_jira_strings
+    3. Attach the found tickets to each test by its query strings
+    :type tests: list(InternalTest)
+    :rtype: list(InternalTest)
+    """
+    query_strings = {query_string for test in tests for query_string in _get_query_strings(test)}
+    log.info(f"Getting jira tickets for {len(query_strings)} distinct strings of {len(tests)} tests")
+    if config.use_jira_store:
+        tickets = _get_jira_store().match(query_strings)
+    else:
+        tickets = query_jira_strings(query_strings)
+    for test in tests:
+        for query_string in _get_query_strings(test):
+            test._related_tickets.extend(tickets[query_string])
+        _update_related_tickets(test)
+    return tests
+
+
+def _get_jira_store():
+    """
+    Return the jira store of the process, so its tickets are loaded and indexed once and not on
+    every match
+    :rtype: JiraStore
+    """
+    global _jira_store
+    with _jira_store_lock:
+        if _jira_store is None:
+            _jira_store = JiraStore()
+        return _jira_store
+
+
+def query_jira_strings(query_strings):
+    """
+    1. Take the strings that were already queried from the cache: first from the local cache, and
+        then the rest from the shared cache in a single call, outside of the cache lock
+    2. Split the rest of the strings into batches, that are limited by the number of strings and
+        the length of the query, and search each batch with a single JQL query that ORs all of its
+        strings. The batches are searched concurrently
+    3. Match the returned tickets back to each string by the same summary and description check
+        as _query_jira, and save the results in cache, in a single call to the shared cache
+    4. Strings of a batch that failed, or whose results may be truncated even when searched
+        alone, are queried one by one
+    :type query_strings: iterable
+    :rtype: dict
+    """
+    query_strings = set(query_strings)
+    tickets = _get_cached(query_strings)
+    missing_strings = sorted(query_strings - set(tickets))
+    batches = _split_query_strings(missing_strings)
+    log.info(f"Searching jira for {len(missing_strings)} strings in {len(batches)} queries")
+    with log.silence_log_output(), ThreadPoolExecutor(config.jira_max_workers) as executor:
+        for batch_tickets in executor.map(_search_jira_batch, batches):
+            tickets.update(batch_tickets)
+    _add_to_cache({query_string: tickets[query_string]
+                   for query_string in missing_strings if query_string in tickets})
+    for query_string in missing_strings:
+        if query_string not in tickets:
+            tickets[query_string] = _safe_query_jira(query_string)
+    return tickets
+
+
+def _get_cached(arguments):
+    """
+    1. Take the values of the arguments that are kept in the local cache
+    2. Get the rest from the shared cache in a single call, outside of the cache lock, and keep
+        them locally
+    :type arguments: iterable
+    :rtype: dict
+    """
+    values = {}
+    missing_arguments = []
+    with cache_lock:
+        for argument in set(arguments):
+            try:
+                values[argument] = cache[hashkey(argument)]
+            except KeyError:
+                missing_arguments.append(argument)
+    shared_values = cache.get_many_shared(hashkey(argument) for argument in missing_arguments)
+    with cache_lock:
+        for argument in missing_arguments:
+            if hashkey(argument) in shared_values:
+                values[argument] = cache[hashkey(argument)] = shared_values[hashkey(argument)]
+    return values
+
+
+def _add_to_cache(values):
+    """
+    Add the values of the arguments to the local cache, and to the shared cache in a single call
+    outside of the cache lock
+    :type values: dict
+    """
+    with cache_lock:
+        for argument, value in values.items():
+            cache[hashkey(argument)] = value
+    cache.set_many_shared({hashkey(argument): value for argument, value in values.items()})
 
 
-def get_jira_tickets(test):
+def _split_query_strings(query_strings):
     """
-    1. Get all jira tickets that contain test name
-    2. Filter tickets that contain specifically the test name in summary and description
-    3. Get all jira tickets that contain the errors in the test
-    5. Search tickets by test id
-    4. existing_jira_tickets keeps already the tickets that were queried. This specifically apply
-        for repearing errors under different tests
+    Split the strings into batches, so the JQL query of each batch doesn't exceed
+    config.jira_max_query_length and config.jira_max_strings_per_query
+    :type query_strings: list
+    :rtype: list(list)
+    """
+    batches = []
+    batch = []
+    query_length = len(config.jira_batch_query)
+    for query_string in query_strings:
+        condition_length = len(_get_text_condition(query_string)) + len(" or ")
+        if batch and (len(batch) == config.jira_max_strings_per_query or
+                      query_length + condition_length > config.jira_max_query_length):
+            batches.append(batch)
+            batch = []
+            query_length = len(config.jira_batch_query)
+        batch.append(query_string)
+        query_length += condition_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _search_jira_batch(query_strings):
+    """
+    1. Search the tickets of all the strings with a single JQL query and match them to each string
+    2. If the search returned config.jira_max_results tickets, the results may be truncated, so
+        the batch is split in two and each half is searched again. A single string with truncated
+        results is left out, so it's queried by itself and not cached as a partial result
+    :type query_strings: list
+    :rtype: dict
+    """
+    with document_exception(f"Failed to search jira for {len(query_strings)} strings"):
+        query = config.jira_batch_query.format(
+            ' or '.join(_get_text_condition(query_string) for query_string in query_strings))
+        tickets = client.search(query)
+        if len(tickets) >= config.jira_max_results:
+            if len(query_strings) == 1:
+                return {}
+            middle = len(query_strings) // 2
+            return {**_search_jira_batch(query_strings[:middle]),
+                    **_search_jira_batch(query_strings[middle:])}
+        return {query_string: [StoredTicket.from_ticket(ticket) for ticket in tickets
+                               if _ticket_contains(ticket, query_string)]
+                for query_string in query_strings}
+    return {}
+
+
+def _get_text_condition(query_string):
+    """
+    Escape the backslashes before the quotes, so a backslash in the string doesn't escape the
+    quote that closes the phrase
+    :type query_string: str
+    :rtype: str
+    """
+    return config.jira_text_condition.format(
+        query_string.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _get_query_strings(test):
+    """
+    Return the strings that related tickets are searched by: test name, the test errors that are
+    not generic or too long, and the test id
     :type test: InternalTest
+    :rtype: list
     """
-    log.debug(f"Getting jira tickets for {test.test_name}")
-    search_for_jira_tickets(test, test.test_name)
+    query_strings = [test.test_name]
     for error in test._errors:
         error_message = error.get('message').replace("{", '').replace("}", '')
         if error_message not in config.generic_errors and len(error_message) < 150:
-            log.debug(f"Getting jira tickets for error: {error_message}")
-            search_for_jira_tickets(test, error_message)
-    log.debug(f"Getting jira tickets for id {test._id}")
-    search_for_jira_tickets(test, test._id)
+            query_strings.append(error_message)
+    query_strings.append(test._id)
+    return query_strings
+
+
+def _safe_query_jira(query_string):
+    with document_exception(f"Failed to query jira for {query_string}"):
+        return _query_jira(query_string)
+    return []
+
+
+def _update_related_tickets(test):
     if test._related_tickets:
         test.related_tickets = '    '.join(
             {config.jira_link_status.format(ticket.key, ticket.get_resolution()) for ticket in
              test._related_tickets})
 
 
-@cached(cache)
+@shared_cached(cache, cache_lock)
 def get_ticket_status(test_blocker):
     with log.silence_log_output():
         issue = client.get_issue(test_blocker)
-        return f"{issue.get_status()} - {issue.get_resolution()}"
+        return _format_ticket_status(issue)
 
 
-def search_for_jira_tickets(test, query_string):
+def get_tickets_status(ticket_keys):
     """
-    1. Silence the log
-    2. Perform JIRA query and then verify that the specific, full string really appears in the
-        summary or the description
-    :type test: InternalTest
-    :type query_string: str
+    1. Take the statuses that were already queried from the cache, local or shared
+    2. Split the rest of the distinct tickets into batches and get each batch with a single
+        `key in (...)` search, running the searches concurrently. The batches are no larger than
+        config.jira_max_results, so the search returns all of their tickets
+    3. Save the statuses in cache, so get_ticket_status will use them as well
+    4. Tickets that couldn't be found by the batch search (e.g. the batch contains an invalid
+        ticket) are queried one by one
+    :type ticket_keys: iterable
+    :rtype: dict
     """
-    with document_exception(), log.silence_log_output():
-        tickets = _query_jira(query_string)
-        test._related_tickets.extend(tickets)
+    ticket_keys = set(ticket_keys)
+    statuses = _get_cached(ticket_keys)
+    ticket_keys = sorted(ticket_keys - set(statuses))
+    batch_size = min(config.jira_batch_size, config.jira_max_results)
+    batches = [ticket_keys[index:index + batch_size]
+               for index in range(0, len(ticket_keys), batch_size)]
+    found_statuses = {}
+    with log.silence_log_output(), ThreadPoolExecutor(config.jira_max_workers) as executor:
+        for batch_statuses in executor.map(_search_tickets_status, batches):
+            found_statuses.update(batch_statuses)
+    _add_to_cache(found_statuses)
+    statuses.update(found_statuses)
+    for ticket_key in ticket_keys:
+        if ticket_key not in statuses:
+            statuses[ticket_key] = get_ticket_status(ticket_key)
+    return statuses
+
+
+def _search_tickets_status(ticket_keys):
+    with document_exception(f"Failed to get status of tickets: {ticket_keys}"):
+        return {ticket.key: _format_ticket_status(ticket) for ticket in
+                client.search(f"key in ({', '.join(ticket_keys)})")}
+    return {}
+
+
+def _format_ticket_status(ticket):
+    return f"{ticket.get_status()} - {ticket.get_resolution()}"
+
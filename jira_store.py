@@ -0,0 +1,258 @@
+import os
+import re
+import sqlite3
+import threading
+from array import array
+from collections import deque
+
+import arrow
+import baker
+from ecosystem.jira import client
+
+import config
+import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    key TEXT PRIMARY KEY,
+    summary TEXT,
+    description TEXT,
+    status TEXT,
+    resolution TEXT,
+    updated REAL);
+CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value REAL);
+CREATE INDEX IF NOT EXISTS tickets_updated ON tickets (updated);
+"""
+
+WATERMARK = "updated"
+
+WORD = re.compile(r"\w+")
+
+
+class StoredTicket(object):
+    """
+    Ticket of the local store, with the same getters as the tickets that are returned by the jira
+    client
+    """
+    __slots__ = ('key', 'summary', 'description', 'status', 'resolution')
+
+    def __init__(self, key, summary, description, status, resolution):
+        self.key = key
+        self.summary = summary
+        self.description = description
+        self.status = status
+        self.resolution = resolution
+
+    @classmethod
+    def from_ticket(cls, ticket):
+        """
+        Copy the fields of a ticket that is returned by the jira client, so it can be stored and
+        shared between processes
+        :rtype: StoredTicket
+        """
+        return cls(ticket.key, ticket.get_summary(), ticket.get_field("description"),
+                   str(ticket.get_status()), ticket.get_resolution())
+
+    def get_summary(self):
+        return self.summary
+
+    def get_field(self, field_name):
+        return getattr(self, field_name, None)
+
+    def get_status(self):
+        return self.status
+
+    def get_resolution(self):
+        return self.resolution
+
+
+class PatternsMatcher(object):
+    """
+    Aho-Corasick automaton over a list of patterns, that finds all the patterns that appear in a
+    text in a single pass over the text
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._output[state] += (index,)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def search(self, text):
+        """
+        Return the indexes of the patterns that appear in the text
+        :type text: str
+        :rtype: set
+        """
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._output[state]:
+                found.update(self._output[state])
+        return found
+
+
+class JiraStore(object):
+    """
+    Local copy of the jira tickets of the projects in config.jira_query, that is kept up to date by
+    sync() and matches query strings against the summary and description of all the tickets. The
+    loaded tickets are kept until the store is synced, so the same store should be reused by all
+    the matches of the process
+    """
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path if file_path else os.path.join(config.get_util_dir(),
+                                                                  config.jira_store_file)
+        self.connection = sqlite3.connect(self.file_path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self._tickets = None
+        self._words_index = None
+        self._loaded_watermark = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """
+        1. Get the latest update time of the stored tickets, minus config.jira_store_sync_overlap,
+            since jira searches by minutes in the timezone of the user
+        2. Fetch all the tickets that were updated since then, by update time, and replace the
+            stored version. A search returns up to config.jira_max_results tickets, so while the
+            searches are full, the next search starts from the update time of the last ticket, as
+            returned by jira in the timezone of the user
+        3. Remove the tickets that weren't updated in the last config.jira_store_days
+        :rtype: int
+        """
+        watermark = self._get_watermark()
+        if watermark is None:
+            watermark = arrow.utcnow().shift(days=-config.jira_store_days).float_timestamp
+        updated_after = arrow.get(watermark - config.jira_store_sync_overlap).format(
+            'YYYY/MM/DD HH:mm')
+        synced_keys = set()
+        while True:
+            log.info(f"Syncing jira tickets that were updated since {updated_after}")
+            with log.silence_log_output():
+                tickets = client.search(config.jira_store_query.format(updated_after))
+            with self.connection:
+                for ticket in tickets:
+                    updated = arrow.get(ticket.get_field("updated")).float_timestamp
+                    stored_ticket = StoredTicket.from_ticket(ticket)
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO tickets VALUES (?, ?, ?, ?, ?, ?)",
+                        (stored_ticket.key, stored_ticket.summary, stored_ticket.description,
+                         stored_ticket.status, stored_ticket.resolution, updated))
+                    watermark = max(watermark, updated)
+                    synced_keys.add(stored_ticket.key)
+                self.connection.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                                        (WATERMARK, watermark))
+            if len(tickets) < config.jira_max_results:
+                break
+            last_updated = arrow.get(tickets[-1].get_field("updated")).format('YYYY/MM/DD HH:mm')
+            if last_updated == updated_after:
+                log.warning(f"More than {config.jira_max_results} jira tickets were updated at "
+                            f"{updated_after}, some of them may not be synced")
+                break
+            updated_after = last_updated
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM tickets WHERE updated < ?",
+                (arrow.utcnow().shift(days=-config.jira_store_days).float_timestamp,))
+        self._tickets = None
+        log.info(f"{len(synced_keys)} jira tickets were synced")
+        return len(synced_keys)
+
+    def _get_watermark(self):
+        row = self.connection.execute("SELECT value FROM sync_state WHERE name = ?",
+                                      (WATERMARK,)).fetchone()
+        return row[0] if row else None
+
+    def _load(self):
+        """
+        Load the tickets that _query_jira would return and index the words of their summary and
+        description
+        """
+        excluded = config.jira_excluded_resolutions
+        self._tickets = [StoredTicket(*row) for row in self.connection.execute(
+            f"SELECT key, summary, description, status, resolution FROM tickets WHERE "
+            f"resolution IS NULL OR resolution NOT IN ({', '.join('?' * len(excluded))})",
+            excluded)]
+        self._words_index = {}
+        for index, ticket in enumerate(self._tickets):
+            for word in {word for text in _get_texts(ticket) for word in WORD.findall(text)}:
+                self._words_index.setdefault(word, array('I')).append(index)
+
+    def match(self, query_strings):
+        """
+        Return the tickets that contain each of the query strings in their summary or description:
+        1. Strings that contain a whole word (the words at the edges of the string may be only
+            part of a longer word in the ticket, so they aren't used) are checked only in the
+            tickets of their rarest whole word, using the words index
+        2. The rest of the strings are matched together in a single pass over all the tickets
+        The tickets are loaded on the first match, and reloaded only if the store was synced since
+        :type query_strings: iterable
+        :rtype: dict
+        """
+        with self._lock:
+            watermark = self._get_watermark()
+            if self._tickets is None or watermark != self._loaded_watermark:
+                self._load()
+                self._loaded_watermark = watermark
+            tickets = {query_string: [] for query_string in query_strings}
+            query_strings = [query_string for query_string in tickets if query_string]
+            scanned_strings = []
+            for query_string in query_strings:
+                words = WORD.findall(query_string)[1:-1]
+                if not words:
+                    scanned_strings.append(query_string)
+                    continue
+                candidates = min((self._words_index.get(word, ()) for word in words), key=len)
+                tickets[query_string] = [self._tickets[index] for index in candidates
+                                         if any(query_string in text
+                                                for text in _get_texts(self._tickets[index]))]
+            if scanned_strings:
+                matcher = PatternsMatcher(scanned_strings)
+                for ticket in self._tickets:
+                    for index in set().union(*map(matcher.search, _get_texts(ticket))):
+                        tickets[scanned_strings[index]].append(ticket)
+            return tickets
+
+
+def _get_texts(ticket):
+    return [text for text in (ticket.summary, ticket.description) if text]
+
+
+@baker.command
+def sync_jira_store(file_path=None):
+    """
+    Fetch all the jira tickets that were updated since the last sync into the local jira store
+    :type file_path: str
+    """
+    JiraStore(file_path).sync()
+
+
+if __name__ == '__main__':
+    log.init_log(log_file=False)
+    baker.run()
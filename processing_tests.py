@@ -1,8 +1,7 @@
-import arrow
-
 import config
 from elastic_search_queries import ElasticSearch, InternalTest
-from jira_queries import get_jira_tickets
+from jira_queries import attach_jira_tickets
+from tests_mirror import TestsMirror
 
 
 def get_sorted_tests_list(**kwargs):
@@ -16,10 +15,11 @@ def _project_is_automation(test):
         2. In case infinitest-version is among session metadata keys - for old infra tests
         3. if the word suite appears in the commandline, but the project isn't specified - this is
             for suite executions where the project isn't specified
+    The session metadata is missing if the test has none of the projected metadata keys
     :type test: dict
     :rtype: bool
     """
-    session_metadata = test['_source']['session_metadata']
+    session_metadata = test['_source'].get('session_metadata') or {}
     return (session_metadata.get("Project") and session_metadata["Project"] in config.auto_projects) \
            or 'infinitest-version' in session_metadata \
            or ('slash::commandline' in session_metadata and "suite" in session_metadata['slash::commandline']) \
@@ -28,11 +28,12 @@ def _project_is_automation(test):
 
 def get_tests(**kwargs):
     """
-    1. Get results from elastic search
+    1. Get results from elastic search, or from the local tests mirror if it's enabled
     2. Convert tests to InternalTest object, in case test_params=False, the InternalTest object will
         be initiated without test parameters
     3. If the request is without test_params, squash tests based on identical name, to avoid
         repetitions
+    4. If jira tickets are required, attach them to all the tests at once
     """
 
     def test_should_be_added(test, coverage):
@@ -56,14 +57,18 @@ def get_tests(**kwargs):
                 test_names.update({test_full_name: status})
                 return True
 
-    elastic_search = ElasticSearch()
-    meta_tests = elastic_search.get_test_results(**kwargs)
+    if kwargs.get('mirror', config.use_tests_mirror):
+        meta_tests = TestsMirror().iter_test_results(**kwargs)
+    else:
+        meta_tests = ElasticSearch().iter_test_results(**kwargs)
     with_jira_tickets = kwargs.get('with_jira_tickets')
     test_params = kwargs.get('test_params', True)
     test_names = {}
-    for meta_test in meta_tests:
-        if test_should_be_added(meta_test, kwargs.get("coverage")):
-            yield InternalTest(meta_test, test_params=test_params, jira_tickets=with_jira_tickets)
+    tests = (InternalTest(meta_test, test_params=test_params, jira_tickets=with_jira_tickets)
+             for meta_test in meta_tests if test_should_be_added(meta_test, kwargs.get("coverage")))
+    if with_jira_tickets:
+        tests = attach_jira_tickets(list(tests))
+    yield from tests
 
 
 def additional_processing(tests, kwargs):
@@ -74,8 +79,7 @@ def additional_processing(tests, kwargs):
     :type kwargs: dict
     """
     if kwargs.get('with_jira_tickets'):
-        for test in tests:
-            get_jira_tickets(test)
+        attach_jira_tickets(tests)
 
 
 def _sort_tests(tests):
@@ -84,6 +88,5 @@ def _sort_tests(tests):
     :type tests: list
     :rtype: list
     """
-    tests.sort(key=lambda test: arrow.get(test.start_time, 'DD-MM-YY HH:mm:ss').timestamp,
-               reverse=True)
+    tests.sort(key=lambda test: test._start_time, reverse=True)
     return tests
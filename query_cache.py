@@ -0,0 +1,88 @@
+import copy
+import hashlib
+import json
+
+import arrow
+
+import config
+import log
+from cache_client import get_from_cache, add_to_cache
+
+
+def iter_partitioned_results(elastic_search, query, days):
+    """
+    Execute query over the tests that were updated in the last days, one day at a time:
+    1. Split the days window into days partitions, starting from today
+    2. Days that are already over don't change anymore, so they are fetched once and kept in cache,
+        while the current day is always fetched from the server
+    3. Test that was updated in more than one day is returned only once, using its latest update
+    4. Filter out tests of the first day that were updated before the window started
+    :type elastic_search: elastic_search_queries.ElasticSearch
+    :type query: dict
+    :type days: int
+    :rtype: Iterator[dict]
+    """
+    now = arrow.utcnow()
+    window_start = now.shift(days=-days)
+    query = _with_updated_at(query)
+    query_key = _get_query_key(query)
+    returned_ids = set()
+    partition_start = now.floor('day')
+    while partition_start.shift(days=1) > window_start:
+        partition_end = partition_start.shift(days=1)
+        if partition_end.shift(seconds=config.partition_close_delay) > now:
+            tests = elastic_search.iter_query_results(
+                _partition_query(query, partition_start, partition_end))
+        else:
+            tests = _get_closed_partition(elastic_search, query, query_key, partition_start,
+                                          partition_end)
+        for test in tests:
+            if test['_id'] in returned_ids:
+                continue
+            if partition_start < window_start and \
+                    arrow.get(test['_source']['updated_at']) <= window_start:
+                continue
+            returned_ids.add(test['_id'])
+            yield test
+        partition_start = partition_start.shift(days=-1)
+
+
+def _get_closed_partition(elastic_search, query, query_key, partition_start, partition_end):
+    cache_key = f"es_partition_{query_key}_{partition_start.format('YYYY-MM-DD')}"
+    tests = get_from_cache(cache_key)
+    if tests is None:
+        log.info(f"Partition {partition_start.format('YYYY-MM-DD')} isn't cached, fetching it")
+        tests = elastic_search.post_query_request(
+            _partition_query(query, partition_start, partition_end))
+        add_to_cache(cache_key, tests, days_to_keep=config.closed_partition_days_to_keep)
+    return tests
+
+
+def _with_updated_at(query):
+    """
+    The update time is required to filter the first partition, so make sure it's returned
+    :type query: dict
+    :rtype: dict
+    """
+    query = copy.deepcopy(query)
+    if '_source' in query and 'updated_at' not in query['_source']:
+        query['_source'] = query['_source'] + ['updated_at']
+    return query
+
+
+def _partition_query(query, partition_start, partition_end):
+    partition_query = copy.deepcopy(query)
+    partition_query['query']['bool']['must'].append(
+        {"range": {"updated_at": {"gte": partition_start.isoformat(),
+                                  "lt": partition_end.isoformat()}}})
+    return partition_query
+
+
+def _get_query_key(query):
+    """
+    Return identifier of the query, without the days range
+    :type query: dict
+    :rtype: str
+    """
+    normalized_query = {key: value for key, value in query.items() if key != "search_after"}
+    return hashlib.sha1(json.dumps(normalized_query, sort_keys=True).encode()).hexdigest()
@@ -132,8 +132,7 @@ def _list_to_html(lst):
 
 def _get_table_headers(tests):
     headers = ''.join([config.bold_cell_style.format(value.title())
-                       for value in tests[0].__dict__.keys()
-                       if not value.startswith('_')])
+                       for value in tests[0].get_display_fields()])
     return f"<tr>{headers}</tr>"
 
 
@@ -182,10 +181,9 @@ def create_tests_table(tests, header=''):
         cell = config.cell_style
         for index, test in enumerate(tests):
             if index == 0:
-                html_text += f"<tr>{''.join([config.bold_cell_style.format(value.title()) for value in test.__dict__.keys() if not value.startswith('_')])}</tr>"
+                html_text += _get_table_headers(tests)
             html_text += "<tr>"
-            html_text += ''.join(
-                [cell.format(value) for key, value in test.__dict__.items() if not key.startswith('_')])
+            html_text += ''.join([cell.format(value) for value in test.get_display_values()])
             html_text += "</tr>"
         html_text += "</table>"
         header += f"<b> {index + 1} tests</b><br>"
@@ -285,6 +283,14 @@ def create_coverage_report(header, coverage_data, errors):
     return table_of_contents(html_text)
 
 
+def create_errors_histogram(header, errors):
+    html_text = f"<h2>{header}</h2><br>"
+    html_text += f"<h3>{sum(errors.values())} errors were found</h3>"
+    html_text += graphs.create_graph_bar(errors)
+    html_text += graphs.create_2_columns_table(["Error Name", "Occurrences"], errors)
+    return html_text
+
+
 def _adjust_tests_to_table(coverage_data, key_name):
     return [[full_test.split(":")[1] for full_test in coverage_data[key_name].keys()]] +\
                           [[status["SUCCESS"] for status in coverage_data[key_name].values()]] +\
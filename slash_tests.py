@@ -2,6 +2,7 @@ import ast
 import glob
 import os
 import subprocess
+from array import array
 
 import baker
 
@@ -11,6 +12,69 @@ from exceptions import document_exception
 from git_utils import get_latest_tag
 
 
+_tests_indexes = {}
+
+
+class SubstringIndex(object):
+    """
+    Trigram index over list of strings, used to find the strings that contain a given substring
+    without going over all of them:
+    1. Each trigram of each string points to the strings it appears in
+    2. The candidates are the strings that contain the rarest trigram of the substring, and only
+        they are checked with `in`. Substrings shorter than a trigram check all the strings
+    """
+
+    def __init__(self, values):
+        self.values = list(values)
+        self._postings = {}
+        for index, value in enumerate(self.values):
+            for trigram in _get_trigrams(value):
+                self._postings.setdefault(trigram, array('I')).append(index)
+
+    def search(self, substring):
+        """
+        Return the indexes of the strings that contain the substring
+        :type substring: str
+        :rtype: list
+        """
+        trigrams = _get_trigrams(substring)
+        if trigrams:
+            candidates = min((self._postings.get(trigram, ()) for trigram in trigrams), key=len)
+        else:
+            candidates = range(len(self.values))
+        return [index for index in candidates if substring in self.values[index]]
+
+
+def _get_trigrams(value):
+    return {value[index:index + 3] for index in range(len(value) - 2)}
+
+
+class TestsIndex(object):
+    """
+    Substring index over the test keys and the test names of the repo tests
+    """
+
+    def __init__(self, tests):
+        self.test_keys = list(tests)
+        self._keys_index = SubstringIndex(self.test_keys)
+        self._names_index = SubstringIndex(tests[test_key][0]['test_name']
+                                           for test_key in self.test_keys)
+
+    def find(self, partial_test_name, include_dir_names=True):
+        """
+        Return the test keys that contain the partial test name. If dir names shouldn't be included,
+        the partial test name should also be part of the test name
+        :type partial_test_name: str
+        :type include_dir_names: bool
+        :rtype: list
+        """
+        matching_keys = self._keys_index.search(partial_test_name)
+        if not include_dir_names:
+            matching_names = set(self._names_index.search(partial_test_name))
+            matching_keys = [index for index in matching_keys if index in matching_names]
+        return [self.test_keys[index] for index in matching_keys]
+
+
 def get_suite_files(suite_directory):
     """
     Iterate through the given suite directory and return all its files
@@ -22,7 +86,7 @@ def get_suite_files(suite_directory):
             "all_tests.suite" not in full_path]
 
 
-@redis_cache
+@redis_cache(key_builder=lambda git_tag, infinibox_tests_path: git_tag)
 def get_all_tests(git_tag, infinibox_tests_path):
     log.info(f"Processing all tests by executing slash list for version: {git_tag}")
     test_lines = str(subprocess.check_output(["./get_slash_lists.sh", "slash_list_tests"])).split("\\n")[:-1]
@@ -104,7 +168,8 @@ def get_updated_tests(working_tree_dir, env_dir):
     current_tag = {'tag_main_ver': git_tag.split('.',1)[0], "tag_revision": git_tag.split('-')[1]}
     os.environ["INFINIBOX_TESTS"] = working_tree_dir
     os.environ["ENV_PATH"] = os.path.join(env_dir, 'bin/activate')
-    get_all_tests(str(current_tag), working_tree_dir)
+    tests = get_all_tests(str(current_tag), working_tree_dir)
+    add_to_cache(_get_index_key(str(current_tag)), TestsIndex(tests))
     _update_latest_tag_in_cache(current_tag)
 
 
@@ -132,6 +197,34 @@ def get_latest_tests():
         return get_from_cache(str(latest_tag))
 
 
+def get_latest_tests_index():
+    """
+    1. Get latest tag from cache
+    2. If the index of the tag was already loaded by this process, return it
+    3. Otherwise, load the index that was saved next to the tests of the tag, or build it from the
+        tests if it's missing
+    :rtype: TestsIndex
+    """
+    latest_tag = get_from_cache("latest_tag")
+    if not latest_tag:
+        return
+    if str(latest_tag) not in _tests_indexes:
+        tests_index = get_from_cache(_get_index_key(str(latest_tag)))
+        if tests_index is None:
+            tests = get_from_cache(str(latest_tag))
+            if not tests:
+                return
+            tests_index = TestsIndex(tests)
+            add_to_cache(_get_index_key(str(latest_tag)), tests_index)
+        _tests_indexes.clear()
+        _tests_indexes[str(latest_tag)] = tests_index
+    return _tests_indexes[str(latest_tag)]
+
+
+def _get_index_key(tag):
+    return f"{tag}_index"
+
+
 if __name__ == '__main__':
     log.init_log(log_file=False)
     baker.run()
\ No newline at end of file
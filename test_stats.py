@@ -46,7 +46,8 @@ def divide_tests_by_filename(tests):
 def _get_additional_details(test_name, file_name, test_details):
     """
     1. get tests that match both name and file path
-    2. Squash all test params and add it to the single details dict that reflects full test
+    2. Squash all test params and add it to a copy of the details dict that reflects full test,
+        since the tests details are shared by the cache
     :type test_name: str
     :type file_name: str
     :type test_details: dict
@@ -58,7 +59,7 @@ def _get_additional_details(test_name, file_name, test_details):
     except StopIteration:
         log.warning(f"Could not find {test_name}-{file_name} in updated tests")
         return {detail: NA for detail in DETAIL_NAMES}
-    details = related_tests[0]
+    details = dict(related_tests[0])
     details['test_params'] = [test.get('params_dict') for test in related_tests]
     details['test_suite'] = ', '.join(details.get('test_suite')) if details.get('test_suite') else None
     return details
@@ -0,0 +1,313 @@
+import cache_client
+import cache_codec
+import config
+from cache_codec import encode
+
+
+def test_get_undecodable_value(monkeypatch):
+    """
+    Steps:
+        Get values that were compressed by a compression that isn't installed in this process
+    Expected:
+        The values should be treated as missing, instead of failing the get
+    """
+    encoded_data = encode({"tests": list(range(100))}, compression="zlib", threshold=0)
+    encoded_data = cache_codec.MAGIC + bytes([255]) + encoded_data[len(cache_codec.MAGIC) + 1:]
+
+    def call_cache_server(method_name, *args):
+        if method_name == "exposed_get_many":
+            return (encoded_data, encode("latest_tag"))
+        return 1, encoded_data
+
+    monkeypatch.setattr(cache_client, "call_cache_server", call_cache_server)
+    monkeypatch.setattr(cache_client, "_local_cache", cache_client.LocalCache())
+    assert cache_client.get_from_cache("tests") is None
+    assert cache_client.get_many(["tests", "tag"]) == {"tag": "latest_tag"}
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeConnection(object):
+    """
+    Connection whose exposed methods return their name, or raise EOFError if it's broken
+    """
+
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+        self.pings = 0
+        self.root = self
+
+    def __getattr__(self, method_name):
+        def method(*args):
+            if self.broken:
+                raise EOFError("Connection closed by peer")
+            return method_name
+        return method
+
+    def ping(self, timeout=None):
+        self.pings += 1
+        if self.broken:
+            raise EOFError("Connection closed by peer")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRpyc(object):
+    """
+    Replace rpyc.connect, opening new fake connections, or failing while the server is down
+    """
+
+    def __init__(self):
+        self.connections = []
+        self.server_down = False
+
+    def connect(self, url, port, config=None):
+        if self.server_down:
+            raise ConnectionRefusedError("Connection refused")
+        self.connections.append(FakeConnection())
+        return self.connections[-1]
+
+
+def _get_pool(monkeypatch):
+    clock = FakeClock()
+    fake_rpyc = FakeRpyc()
+    monkeypatch.setattr(cache_client, "time", clock)
+    monkeypatch.setattr(cache_client.rpyc, "connect", fake_rpyc.connect)
+    monkeypatch.setattr(config, "cache_server_up", True)
+    pool = cache_client.ConnectionPool("cache_server", 6378, max_size=2)
+    monkeypatch.setattr(cache_client, "_pool", pool)
+    return pool, fake_rpyc, clock
+
+
+def test_connection_pool_reuse(monkeypatch):
+    """
+    Steps:
+        1. Call the cache server one call after the other, and with concurrent calls
+        2. Call the cache server after the connections were idle for the health check interval,
+            when one of them is broken
+    Expected:
+        1. Idle connections should be reused, and concurrent calls should use different connections
+        2. Idle connections should be pinged before they are reused, and the broken connection
+            should be closed and replaced
+    """
+    pool, fake_rpyc, clock = _get_pool(monkeypatch)
+    assert cache_client.call_cache_server("exposed_get") == "exposed_get"
+    assert cache_client.call_cache_server("exposed_get") == "exposed_get"
+    assert len(fake_rpyc.connections) == 1
+    with pool.connection() as first_connection, pool.connection() as second_connection:
+        assert first_connection is not second_connection
+    assert len(fake_rpyc.connections) == 2
+    clock.now += config.cache_health_check_interval + 1
+    second_connection.broken = True
+    with pool.connection() as connection, pool.connection() as other_connection:
+        assert {connection, other_connection} == {first_connection, fake_rpyc.connections[2]}
+    assert second_connection.closed and second_connection.pings == 1
+    assert first_connection.pings == 1 and not first_connection.closed
+
+
+def test_connection_pool_reconnect(monkeypatch):
+    """
+    Steps:
+        Call the cache server when its connections broke, e.g. after the server was restarted
+    Expected:
+        1. The broken connection and the idle connections should be closed
+        2. The call should be retried once with a new connection
+    """
+    pool, fake_rpyc, _ = _get_pool(monkeypatch)
+    with pool.connection(), pool.connection():
+        pass
+    for connection in fake_rpyc.connections:
+        connection.broken = True
+    assert cache_client.call_cache_server("exposed_get") == "exposed_get"
+    assert len(fake_rpyc.connections) == 3
+    assert all(connection.closed for connection in fake_rpyc.connections[:2])
+    assert not fake_rpyc.connections[2].closed
+
+
+def test_connection_pool_recovery(monkeypatch):
+    """
+    Steps:
+        Call the cache server while it's down, and again before and after the retry interval
+        passed, when the server is back
+    Expected:
+        1. The cache should be disabled while the server is down, and the calls return None
+        2. Connecting should be retried only after the retry interval, and then the cache should
+            be enabled again
+    """
+    pool, fake_rpyc, clock = _get_pool(monkeypatch)
+    fake_rpyc.server_down = True
+    assert cache_client.call_cache_server("exposed_get") is None
+    assert not config.get_cache_state()
+    fake_rpyc.server_down = False
+    clock.now += config.cache_retry_interval - 1
+    assert cache_client.call_cache_server("exposed_get") is None
+    assert not fake_rpyc.connections
+    clock.now += 2
+    assert cache_client.call_cache_server("exposed_get") == "exposed_get"
+    assert config.get_cache_state() and len(fake_rpyc.connections) == 1
+
+
+class FakeCacheServer(object):
+    """
+    Keep the values with a new generation for every write, and count the values that were
+    transferred by get_if_changed. Locks in held_locks are held by another caller
+    """
+
+    def __init__(self, held_locks=()):
+        self.values = {}
+        self.days_to_keep = {}
+        self.generation = 0
+        self.transferred = 0
+        self.locks = {lock_name: "other_caller" for lock_name in held_locks}
+
+    def __call__(self, method_name, *args):
+        return getattr(self, method_name)(*args)
+
+    def exposed_add_to_cache(self, key_name, data, days_to_keep=None):
+        self.generation += 1
+        self.values[key_name] = (self.generation, data)
+        self.days_to_keep[key_name] = days_to_keep
+
+    def exposed_acquire_lock(self, lock_name, token, timeout):
+        if lock_name in self.locks:
+            return False
+        self.locks[lock_name] = token
+        return True
+
+    def exposed_release_lock(self, lock_name, token):
+        if self.locks.get(lock_name) == token:
+            return bool(self.locks.pop(lock_name))
+        return False
+
+    def exposed_get_if_changed(self, key_name, generation):
+        if key_name not in self.values:
+            return None
+        if self.values[key_name][0] == generation:
+            return generation,
+        self.transferred += 1
+        return self.values[key_name]
+
+
+def _use_fake_server(monkeypatch, held_locks=()):
+    fake_server = FakeCacheServer(held_locks)
+    monkeypatch.setattr(cache_client, "call_cache_server", fake_server)
+    monkeypatch.setattr(cache_client, "_local_cache", cache_client.LocalCache())
+    return fake_server
+
+
+def test_get_from_cache_generation(monkeypatch):
+    """
+    Steps:
+        1. Get an object from cache twice
+        2. Get it after it was changed by this process, and after it was changed by another process
+    Expected:
+        1. The second get should get only the generation, and return the kept object
+        2. Both changes should invalidate the kept object, so the new object is transferred
+    """
+    fake_server = _use_fake_server(monkeypatch)
+    cache_client.add_to_cache("tests", ["test_create_pool"])
+    tests = cache_client.get_from_cache("tests")
+    assert cache_client.get_from_cache("tests") is tests == ["test_create_pool"]
+    assert fake_server.transferred == 1
+    cache_client.add_to_cache("tests", ["test_delete_pool"])
+    assert cache_client.get_from_cache("tests") == ["test_delete_pool"]
+    fake_server.exposed_add_to_cache("tests", encode(["test_resize_pool"]))
+    assert cache_client.get_from_cache("tests") == ["test_resize_pool"]
+    assert fake_server.transferred == 3
+    assert cache_client.get_from_cache("missing") is None
+
+
+def test_local_cache_eviction():
+    """
+    Steps:
+        Put objects in local cache until their estimated size exceeds the maximal size
+    Expected:
+        1. The size of each object should be estimated by its pickled size times the size factor
+        2. The least recently used objects should be evicted, and objects that are larger than the
+            maximal size should not be kept at all
+    """
+    local_cache = cache_client.LocalCache(max_bytes=100, size_factor=2)
+    local_cache.put("a", 1, "a", 20)
+    local_cache.put("b", 1, "b", 20)
+    assert local_cache.size == 80
+    assert local_cache.get("a") == (1, "a")
+    local_cache.put("c", 2, "c", 15)
+    assert local_cache.get("b") is None and local_cache.size == 70
+    local_cache.put("d", 1, "d", 51)
+    assert local_cache.get("d") is None
+    assert local_cache.get("a") == (1, "a") and local_cache.get("c") == (2, "c")
+    local_cache.pop("a")
+    assert local_cache.size == 30
+
+
+def test_redis_cache(monkeypatch):
+    """
+    Steps:
+        Call cached functions with the same arguments, in a different keyword order, with other
+        arguments and with a key builder, when some of the results are falsy
+    Expected:
+        1. The key should be built from all the arguments, or by the key builder if given
+        2. Every result but None should be cached, with the ttl of the decorator, so each function
+            runs once for the same arguments
+    """
+    fake_server = _use_fake_server(monkeypatch)
+    calls = []
+
+    @cache_client.redis_cache(ttl_days=2)
+    def get_tests(version, status=None, coverage=False):
+        calls.append((version, status, coverage))
+        return [] if coverage else [version]
+
+    @cache_client.redis_cache(key_builder=lambda version, **kwargs: f"errors_{version}")
+    def get_errors(version, max_length=None):
+        calls.append(version)
+        return None if version == "missing" else 0
+
+    assert get_tests("5.0", status="ERROR", coverage=True) == []
+    assert get_tests("5.0", coverage=True, status="ERROR") == []
+    assert get_tests("5.0", status="ERROR") == get_tests("5.0", status="ERROR") == ["5.0"]
+    assert get_errors("5.0") == get_errors("5.0", max_length=10) == 0
+    assert get_errors("missing") is get_errors("missing") is None
+    assert calls == [("5.0", "ERROR", True), ("5.0", "ERROR", False), "5.0", "missing", "missing"]
+    assert set(fake_server.days_to_keep.values()) == {2, None}
+    assert fake_server.days_to_keep["errors_5.0"] is None and not fake_server.locks
+
+
+def test_redis_cache_held_lock(monkeypatch):
+    """
+    Steps:
+        Call a cached function when another caller holds the lock of its key, and caches the
+        result while the function waits
+    Expected:
+        1. The function should wait for the lock, and return the result of the other caller
+            without running
+        2. The lock of the other caller should not be released
+    """
+    fake_server = _use_fake_server(monkeypatch, held_locks=["latest_tag"])
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        if len(waits) == 2:
+            fake_server.exposed_add_to_cache("latest_tag", encode("v5.0"))
+
+    monkeypatch.setattr(cache_client.time, "sleep", sleep)
+    calls = []
+
+    @cache_client.redis_cache(key_builder=lambda: "latest_tag")
+    def get_latest_tag():
+        calls.append(1)
+        return "v5.1"
+
+    assert get_latest_tag() == "v5.0" and not calls
+    assert waits == [config.cache_lock_poll_interval] * 2
+    assert fake_server.locks == {"latest_tag": "other_caller"}
@@ -0,0 +1,38 @@
+import pickle
+
+import cache_codec
+
+TESTS = {f"tests/pools/test_pool_{index}.py:test_create_pool": [{"test_name": "test_create_pool",
+                                                                 "test_suite": ["pools"],
+                                                                 "params_dict": {"size": index}}]
+         for index in range(1000)}
+
+
+def test_encode_decode():
+    """
+    Steps:
+        Encode small and large objects, with every compression and with out-of-band buffers
+    Expected:
+        1. Decoded objects should be equal to the encoded objects
+        2. Only objects above the threshold should be compressed
+    """
+    for compression in ["zstd", "lz4", "zlib", None]:
+        for data in [TESTS, "latest_tag", [bytearray(b"buffer" * 10000), {"size": 1}]]:
+            encoded_data = cache_codec.encode(data, compression=compression)
+            assert cache_codec.decode(encoded_data) == data
+            assert encoded_data.startswith(cache_codec.MAGIC)
+            is_compressed = encoded_data[len(cache_codec.MAGIC)] != cache_codec.NO_COMPRESSION
+            assert is_compressed == bool(compression and len(pickle.dumps(data)) >
+                                         cache_codec.DEFAULT_THRESHOLD)
+    assert len(cache_codec.encode(TESTS)) < len(pickle.dumps(TESTS)) / 4
+
+
+def test_decode_legacy_pickle():
+    """
+    Steps:
+        Decode values that were saved by plain pickle, with the current and the oldest protocols
+    Expected:
+        The values should be unpickled
+    """
+    for protocol in [pickle.DEFAULT_PROTOCOL, 0]:
+        assert cache_codec.decode(pickle.dumps(TESTS, protocol=protocol)) == TESTS
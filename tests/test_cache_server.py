@@ -0,0 +1,91 @@
+import pickle
+
+import pytest
+
+import cache_server
+from cache_codec import encode, LIST_ITEM_PROTOCOL
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(cache_server.redis, "Redis", fakeredis.FakeRedis)
+    return cache_server.CacheServer()
+
+
+def _pickle_item(item):
+    return pickle.dumps(item, protocol=LIST_ITEM_PROTOCOL)
+
+
+def test_cache_server_generations(server):
+    """
+    Steps:
+        Add a key with expiration, get it with and without its current generation, and add it again
+    Expected:
+        1. The key and its generation should expire together
+        2. Getting the key with its current generation should return only the generation
+        3. Every write should stamp the key with a new generation
+    """
+    generation = server.exposed_add_to_cache("tests", b"tests", 1)
+    assert 0 < server.r_server.pttl("tests") == server.r_server.pttl("generation:tests")
+    assert server.exposed_get_if_changed("tests", None) == (generation, b"tests")
+    assert server.exposed_get_if_changed("tests", generation) == (generation,)
+    new_generation = server.exposed_add_to_cache("tests", b"new tests")
+    assert new_generation > generation and server.r_server.pttl("tests") == -1
+    assert server.exposed_get_if_changed("tests", generation) == (new_generation, b"new tests")
+    assert server.exposed_get_if_changed("missing", None) is None
+
+
+def test_cache_server_legacy_values(server):
+    """
+    Steps:
+        Get a value that was kept by older servers as a set with a single member
+    Expected:
+        The member should be returned, without a generation
+    """
+    server.r_server.sadd("latest_tag", b"tag")
+    assert server.exposed_get_from_cache("latest_tag") == b"tag"
+    assert server.exposed_get_if_changed("latest_tag", None) == (None, b"tag")
+
+
+def test_cache_server_append_to_list(server):
+    """
+    Steps:
+        1. Append items to a new list, including an item that is already in the list
+        2. Append items to a pickled list of older clients
+    Expected:
+        1. Items should be added only once, and every added item should change the generation
+        2. The pickled list should be converted to a list of pickled items before appending
+    """
+    assert server.exposed_append_to_list("tests", b"a")
+    generation = server.exposed_get_if_changed("tests", None)[0]
+    assert not server.exposed_append_to_list("tests", b"a")
+    assert server.exposed_get_if_changed("tests", generation) == (generation,)
+    assert server.exposed_append_to_list("tests", b"b")
+    assert server.exposed_get_if_changed("tests", generation)[1:] == ((b"a", b"b"),)
+    server.exposed_add_to_cache("legacy_tests", encode([1, 2]))
+    assert server.exposed_append_to_list("legacy_tests", _pickle_item(3))
+    assert not server.exposed_append_to_list("legacy_tests", _pickle_item(2))
+    assert server.exposed_get_from_cache("legacy_tests") == tuple(map(_pickle_item, [1, 2, 3]))
+
+
+def test_cache_server_many_and_locks(server):
+    """
+    Steps:
+        1. Set many keys at once and get them with missing keys and keys of lists
+        2. Acquire a lock that is held, and release it with another token and with its token
+    Expected:
+        1. Only the values that were set should be returned, with a generation for each of them
+        2. The lock should be acquired and released only by its holder
+    """
+    server.exposed_set_many((("a", b"1"), ("b", b"2")), 1)
+    server.exposed_append_to_list("tests", b"a")
+    assert server.exposed_get_many(("a", "b", "tests", "missing")) == (b"1", b"2", None, None)
+    assert server.exposed_get_if_changed("a", None)[0] != server.exposed_get_if_changed("b", None)[0]
+    assert server.exposed_acquire_lock("sync", "first", 10)
+    assert not server.exposed_acquire_lock("sync", "second", 10)
+    assert not server.exposed_release_lock("sync", "second")
+    assert server.exposed_release_lock("sync", "first")
+    assert server.exposed_acquire_lock("sync", "second", 10)
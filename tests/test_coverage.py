@@ -0,0 +1,63 @@
+import config
+from coverage import RepoTestsIndex, classify_flaky_tests
+
+REPO_TESTS = {"tests/a/test_pool.py:test_create": [],
+              "tests/a/test_pool.py:test_create_many": [],
+              "tests/a/test_pool.py:TestPool.test_create": [],
+              "tests/b/test_pool.py:test_create": [],
+              "tests/a/test_volume.py:test_pool": [],
+              "tests/a/test_volume.py:test_create": []}
+
+
+def _match_all_keys(test_module, test_name):
+    return [test_key for test_key in REPO_TESTS if test_name in test_key and test_module in test_key]
+
+
+def test_repo_tests_index_matches_all_keys():
+    """
+    Steps:
+        Resolve executed tests with full, partial and ambiguous modules and names
+    Expected:
+        The resolved keys should be the same keys, in the same order, as checking all the keys
+    """
+    repo_tests_index = RepoTestsIndex(REPO_TESTS)
+    for test_module, test_name in [("tests/a/test_pool.py", "test_create"),
+                                   ("a/test_pool.py", "test_create_many"),
+                                   ("test_pool.py", "test_create"),
+                                   ("tests/a/test_volume.py", "test_pool"),
+                                   ("tests/a/test_volume.py", "test_missing"),
+                                   ("tests/a/test_pool.py", "test_pool"),
+                                   ("tests/c/test_pool.py", "test_create")]:
+        assert repo_tests_index.resolve(test_module, test_name) == \
+               _match_all_keys(test_module, test_name)
+
+
+def test_classify_flaky_tests():
+    """
+    Steps:
+        Classify tests that succeeded and failed, where some of them ended with the same status
+        enough times, counting test params as a single run
+    Expected:
+        Tests should be classified to last successful, last failed or flaky, and the given executed
+        tests should not be changed
+    """
+    threshold = config.definite_executions_threshold
+    repo_tests = {"a": [{}], "b": [{}, {}], "c": [{}], "d": [{}], "e": [{}]}
+    executed_tests = {"SUCCESS": {"a": list(range(100, 100 - threshold, -1)),
+                                  "b": list(range(100, 100 - threshold, -1)),
+                                  "c": [5, 4],
+                                  "d": [50, 10, 40],
+                                  "e": [1]},
+                      "ERROR": {"a": [10],
+                                "b": [10],
+                                "c": list(range(100, 100 - threshold, -1)),
+                                "d": [20]}}
+    classification = classify_flaky_tests(executed_tests, repo_tests)
+    assert classification.executed_tests == {
+        "SUCCESS": {"e": [1]},
+        "ERROR": {},
+        f"Last_{threshold}_SUCCESS": {"a": {"SUCCESS": threshold, "FAILURE": 1}},
+        f"Last_{threshold}_ERROR": {"c": {"SUCCESS": 2, "FAILURE": threshold}}}
+    assert classification.flaky_tests == {"b": {"SUCCESS": threshold, "FAILURE": 1},
+                                          "d": {"SUCCESS": 3, "FAILURE": 1}}
+    assert set(executed_tests["SUCCESS"]) == {"a", "b", "c", "d", "e"}
@@ -1,12 +1,38 @@
 import pytest
 
 import config
-from elastic_search_queries import get_tests_query
+from elastic_search_queries import ElasticSearch, get_tests_query, get_aggregation_query, \
+    _get_test_params
 
 TEST_NAME = "my_test"
 ERROR_NAME = "my_error"
 
 
+class FakeScrollTransport(object):
+    """
+    Transport that returns pages_per_slice pages of two hits for each slice of a sliced scroll
+    """
+
+    def __init__(self, pages_per_slice):
+        self.pages_per_slice = pages_per_slice
+        self.returned_pages = {}
+        self.cleared_scrolls = []
+        self.slice_sorts = []
+
+    def post(self, url, body, params=(), retry=False):
+        if 'slice' in body:
+            self.slice_sorts.append(body['sort'])
+        scroll_id = body.get("scroll_id") or f"scroll_{body['slice']['id']}"
+        page_index = self.returned_pages.get(scroll_id, 0)
+        self.returned_pages[scroll_id] = page_index + 1
+        hits = [{"_id": f"{scroll_id}_{page_index}_{hit}"} for hit in range(2)]
+        return {"_scroll_id": scroll_id,
+                "hits": {"total": 2 * self.pages_per_slice, "hits": hits}}
+
+    def delete(self, url, body):
+        self.cleared_scrolls.extend(body["scroll_id"])
+
+
 def test_get_tests_with_unexpected_args():
     """
     Steps:
@@ -44,3 +70,155 @@ def test_get_tests_without_error():
 
 
 
+
+
+def test_get_tests_query_source_fields():
+    """
+    Steps:
+        Get tests query with and without test params
+    Expected:
+        Only the fields used by the tests should be requested, parameters only when required
+    """
+    query = get_tests_query(test_name=TEST_NAME)
+    assert query['_source'] == config.test_source_fields
+    query = get_tests_query(test_name=TEST_NAME, test_params=False)
+    assert 'parameters' not in query['_source']
+    assert 'test.name' in query['_source']
+
+
+def test_get_tests_query_coverage_source_fields():
+    """
+    Steps:
+        Get coverage tests query
+    Expected:
+        Only the coverage fields should be requested
+    """
+    query = get_tests_query(version="5.0", coverage=True)
+    assert query['_source'] == config.coverage_source_fields
+
+
+def test_get_aggregation_query():
+    """
+    Steps:
+        Get aggregation query by error type for failed tests
+    Expected:
+        Query should keep the tests filter, but return no tests and group them by the error type
+    """
+    query = get_aggregation_query({"error_type": config.error_type_field},
+                                  days=1, status=config.failed_statuses)
+    assert query['size'] == 0
+    assert 'sort' not in query and '_source' not in query
+    assert {'terms': {'status': config.failed_statuses}} in query['query']['bool']['must']
+    assert query['aggs']['buckets']['composite']['sources'] == [
+        {"error_type": {"terms": {"field": config.error_type_field}}}]
+
+
+def test_get_test_params():
+    """
+    Steps:
+        Decode test parameters string with booleans, nulls, numbers and nested values
+    Expected:
+        All the parameter values should be converted to their python string representation
+    """
+    test_data = {'parameters': '{"a": true, "b": null, "c": 1.5, "d": "x", "e": {"f": false}}'}
+    assert _get_test_params(True, test_data) == {'a': 'True', 'b': 'None', 'c': '1.5', 'd': 'x',
+                                                 'e': "{'f': False}"}
+    assert _get_test_params(True, test_data) is not _get_test_params(True, test_data)
+
+
+def test_get_test_params_without_params():
+    """
+    Steps:
+        Decode test parameters when they are not required or missing
+    Expected:
+        No parameters should be returned
+    """
+    assert _get_test_params(False, {'parameters': '{"a": 1}'}) is None
+    assert _get_test_params(True, {'parameters': 'null'}) is None
+    assert _get_test_params(True, {}) is None
+
+
+class FakeAggregationTransport(object):
+    """
+    Transport that returns the tests with the given errors. Aggregation queries return the number
+    of tests of each exception type if aggregate is set, otherwise no buckets, as when the
+    exception type isn't mapped
+    """
+
+    def __init__(self, tests_errors, aggregate=True):
+        self.tests_errors = tests_errors
+        self.aggregate = aggregate
+
+    def post(self, url, body, params=(), retry=False):
+        if 'aggs' in body:
+            doc_counts = {}
+            for errors in self.tests_errors if self.aggregate else []:
+                for error_type in {error.split(":")[0] for error in errors}:
+                    doc_counts[error_type] = doc_counts.get(error_type, 0) + 1
+            return {"hits": {"total": len(self.tests_errors), "hits": []},
+                    "aggregations": {"buckets": {"buckets": [
+                        {"key": {"error_type": error_type}, "doc_count": doc_count}
+                        for error_type, doc_count in doc_counts.items()]}}}
+        return {"hits": {"total": len(self.tests_errors),
+                         "hits": [{"_id": str(index), "sort": [index],
+                                   "_source": {"errors": [{"message": error} for error in errors]}}
+                                  for index, errors in enumerate(self.tests_errors)]}}
+
+
+def test_get_error_counts():
+    """
+    Steps:
+        Count errors of the same tests when the aggregation returns buckets, and when it returns no
+        buckets for matched tests (unmapped exception type), and count errors when no tests are
+        matched
+    Expected:
+        1. Both the aggregation and the errors of the tests should count the number of tests of
+            each exception type, even if a test has several errors of the same type
+        2. No errors should be counted if no tests are matched
+    """
+    tests_errors = [["ValueError: a", "ValueError: b"], ["KeyError: c"],
+                    ["ValueError: d", "KeyError: e"], []]
+    for aggregate in [True, False]:
+        transport = FakeAggregationTransport(tests_errors, aggregate)
+        assert ElasticSearch(transport).get_error_counts(status=config.failed_statuses) == \
+            {"ValueError": 2, "KeyError": 2}
+    transport = FakeAggregationTransport([])
+    assert ElasticSearch(transport).get_error_counts(status=config.failed_statuses) == {}
+
+
+def test_iter_sliced_results():
+    """
+    Steps:
+        Iterate over the results of sliced query, with and without preserving the order
+    Expected:
+        1. All the hits of all the slices should be returned, by the slices order if preserved
+        2. The scroll contexts of all the slices should be cleared
+        3. The slices should be scrolled by _doc order
+    """
+    expected_ids = [f"scroll_{slice_id}_{page_index}_{hit}"
+                    for slice_id in range(3) for page_index in range(10) for hit in range(2)]
+    for preserve_order in [True, False]:
+        transport = FakeScrollTransport(pages_per_slice=10)
+        hits = list(ElasticSearch(transport).iter_sliced_results(
+            get_tests_query(test_name=TEST_NAME), 3, preserve_order=preserve_order))
+        hit_ids = [hit["_id"] for hit in hits]
+        assert hit_ids == expected_ids if preserve_order else sorted(hit_ids) == expected_ids
+        assert sorted(transport.cleared_scrolls) == ["scroll_0", "scroll_1", "scroll_2"]
+        assert transport.slice_sorts == [["_doc"]] * 3
+
+
+def test_iter_sliced_results_stopped():
+    """
+    Steps:
+        Stop iterating over the results of sliced query after the first hit
+    Expected:
+        1. The slices should stop fetching pages once their queue is full
+        2. The scroll contexts of all the slices should be cleared
+    """
+    transport = FakeScrollTransport(pages_per_slice=100)
+    hits = ElasticSearch(transport).iter_sliced_results(get_tests_query(test_name=TEST_NAME), 3)
+    assert next(hits)["_id"] == "scroll_0_0_0"
+    hits.close()
+    assert sorted(transport.cleared_scrolls) == ["scroll_0", "scroll_1", "scroll_2"]
+    assert all(returned_pages <= config.slice_queue_pages + 2
+               for returned_pages in transport.returned_pages.values())
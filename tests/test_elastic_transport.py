@@ -0,0 +1,77 @@
+import gzip
+import json
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+import config
+from elastic_transport import ElasticTransport
+
+
+class FakeAdapter(BaseAdapter):
+    """
+    Adapter that responds to the requests with the given status codes, one after the other, and
+    keeps the bodies of the requests
+    """
+
+    def __init__(self, status_codes):
+        super().__init__()
+        self.status_codes = list(status_codes)
+        self.bodies = []
+
+    def send(self, request, **kwargs):
+        self.bodies.append(json.loads(gzip.decompress(request.body)))
+        response = requests.Response()
+        response.status_code = self.status_codes.pop(0)
+        response._content = json.dumps({"hits": {"total": 0, "hits": []}}).encode()
+        response.headers['Content-Length'] = str(len(response._content))
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def _get_transport(monkeypatch, status_codes):
+    delays = []
+    monkeypatch.setattr("time.sleep", delays.append)
+    transport = ElasticTransport(max_retries=3)
+    adapter = FakeAdapter(status_codes)
+    transport.session.mount("http://", adapter)
+    return transport, adapter, delays
+
+
+def test_transport_retry(monkeypatch):
+    """
+    Steps:
+        Send a request that may be retried, when the server responds with 503 twice
+    Expected:
+        1. The request should be retried with exponential backoff until it succeeds
+        2. The stats should count the successful request and the retries
+    """
+    transport, adapter, delays = _get_transport(monkeypatch, [503, 503, 200])
+    body = {"query": {"match_all": {}}}
+    assert transport.post("http://elastic/_search", body, retry=True) == \
+        {"hits": {"total": 0, "hits": []}}
+    assert adapter.bodies == [body] * 3
+    assert delays == [config.elastic_retry_backoff, config.elastic_retry_backoff * 2]
+    assert (transport.stats.requests, transport.stats.retries) == (1, 2)
+    assert transport.stats.bytes_received == len(json.dumps({"hits": {"total": 0, "hits": []}}))
+
+
+def test_transport_no_retry(monkeypatch):
+    """
+    Steps:
+        1. Send a request that may be retried, when the server responds with 400
+        2. Send a request that may not be retried, when the server responds with 503
+    Expected:
+        The requests should fail without being retried
+    """
+    for status_code, retry in [(400, True), (503, False)]:
+        transport, adapter, delays = _get_transport(monkeypatch, [status_code, 200])
+        with pytest.raises(requests.HTTPError):
+            transport.post("http://elastic/_search/scroll", {"scroll_id": "1"}, retry=retry)
+        assert len(adapter.bodies) == 1 and not delays
+        assert (transport.stats.requests, transport.stats.retries) == (0, 0)
@@ -0,0 +1,59 @@
+import cache_client
+import jira_queries
+from cache_client import SharedCache
+from jira_queries import _get_text_condition
+
+
+class FakeTicket(object):
+
+    def __init__(self, key):
+        self.key = key
+
+    def get_status(self):
+        return "Open"
+
+    def get_resolution(self):
+        return None
+
+
+def test_get_text_condition():
+    """
+    Steps:
+        Get the text condition of strings with quotes and backslashes
+    Expected:
+        Backslashes and quotes should be escaped, so the phrase is closed only by its last quote
+    """
+    assert _get_text_condition('path "C:\\logs\\"') == 'text ~ "path \\"C:\\\\logs\\\\\\""'
+    assert _get_text_condition('line\\n') == 'text ~ "line\\\\n"'
+
+
+def test_get_tickets_status(monkeypatch):
+    """
+    Steps:
+        Get the status of tickets, when one of them is in the shared cache, and get the statuses
+        again
+    Expected:
+        1. Only the tickets that are missing from the cache should be searched
+        2. The searched statuses should be cached, so the second call doesn't search at all
+    """
+    shared_values = {}
+    searches = []
+
+    def search(query):
+        searches.append(query)
+        return [FakeTicket(key) for key in query[len("key in ("):-1].split(", ")]
+
+    monkeypatch.setattr(jira_queries, "cache", SharedCache("jira", maxsize=10, ttl=60,
+                                                           negative_ttl=10))
+    monkeypatch.setattr(cache_client, "get_many", lambda key_names: {
+        key_name: shared_values[key_name] for key_name in key_names if key_name in shared_values})
+    monkeypatch.setattr(cache_client, "set_many",
+                        lambda items, days_to_keep=None: shared_values.update(items))
+    monkeypatch.setattr(jira_queries.client, "search", search)
+    jira_queries.cache.set_many_shared({jira_queries.hashkey("INFRA-1"): "Closed - Fixed"})
+    expected_statuses = {"INFRA-1": "Closed - Fixed", "INFRA-2": "Open - None",
+                         "INFRA-3": "Open - None"}
+    assert jira_queries.get_tickets_status(["INFRA-3", "INFRA-1", "INFRA-2"]) == expected_statuses
+    assert searches == ["key in (INFRA-2, INFRA-3)"]
+    assert jira_queries.get_tickets_status(["INFRA-1", "INFRA-2", "INFRA-3"]) == expected_statuses
+    assert len(searches) == 1
@@ -0,0 +1,128 @@
+import re
+
+import arrow
+
+import config
+import jira_store
+from jira_store import JiraStore, PatternsMatcher
+
+TICKETS = [("INFRA-1", "test_create_pool fails", "VolumeError: volume is mapped", None),
+           ("INFRA-2", "Pool resize timeout", None, "Fixed"),
+           ("INFRA-3", "test_create_pool_many fails", "Timeout: pool resize", "Duplicate"),
+           ("INFRA-4", "create volume", "PoolError: pool not found (id 12)", None)]
+
+
+class FakeTicket(object):
+
+    def __init__(self, key, updated):
+        self.key = key
+        self.updated = updated
+
+    def get_summary(self):
+        return f"{self.key} summary"
+
+    def get_field(self, field_name):
+        return self.updated if field_name == "updated" else None
+
+    def get_status(self):
+        return "Open"
+
+    def get_resolution(self):
+        return None
+
+
+class FakeJiraClient(object):
+    """
+    Return the tickets that were updated since the minute of the query, by update time, up to
+    config.jira_max_results tickets
+    """
+
+    def __init__(self, tickets):
+        self.tickets = tickets
+        self.queries = []
+
+    def search(self, query):
+        self.queries.append(query)
+        updated_after = arrow.get(re.search(r'updated >= "(.*?)"', query).group(1),
+                                  'YYYY/MM/DD HH:mm', tzinfo="+03:00")
+        tickets = sorted((ticket for ticket in self.tickets
+                          if arrow.get(ticket.updated) >= updated_after),
+                         key=lambda ticket: arrow.get(ticket.updated))
+        return tickets[:config.jira_max_results]
+
+
+def test_patterns_matcher():
+    """
+    Steps:
+        Search text for overlapping patterns, patterns that are suffixes of other patterns and
+        missing patterns
+    Expected:
+        All the patterns that appear in the text should be found
+    """
+    patterns = ["pool", "create_pool", "test_create", "ate", "volume", "missing"]
+    matcher = PatternsMatcher(patterns)
+    text = "test_create_pool and test_create_volume"
+    assert matcher.search(text) == {index for index, pattern in enumerate(patterns)
+                                    if pattern in text}
+
+
+def test_jira_store_match(tmpdir):
+    """
+    Steps:
+        Match test names and errors, with and without whole words, against the stored tickets
+    Expected:
+        1. Tickets should match if the string is part of their summary or description
+        2. Tickets with excluded resolutions should not match
+    """
+    jira_store = JiraStore(str(tmpdir.join("jira_store.sqlite")))
+    for key, summary, description, resolution in TICKETS:
+        jira_store.connection.execute("INSERT INTO tickets VALUES (?, ?, ?, 'Open', ?, 0)",
+                                      (key, summary, description, resolution))
+    tickets = jira_store.match(["test_create_pool", "Pool resize", "volume is mapped",
+                                "pool not found (id", "missing error"])
+    assert {query_string: [ticket.key for ticket in query_tickets]
+            for query_string, query_tickets in tickets.items()} == \
+           {"test_create_pool": ["INFRA-1"],
+            "Pool resize": ["INFRA-2"],
+            "volume is mapped": ["INFRA-1"],
+            "pool not found (id": ["INFRA-4"],
+            "missing error": []}
+
+
+def test_jira_store_sync(tmpdir, monkeypatch):
+    """
+    Steps:
+        Sync the store when there are more updated tickets than a single search returns
+    Expected:
+        1. Searches should continue from the update time of the last ticket, in the timezone of
+            jira, until a search isn't full
+        2. All the tickets should be stored, each of them once
+    """
+    now = arrow.utcnow().to("+03:00").floor('minute')
+    tickets = [FakeTicket(f"INFRA-{index}", now.shift(minutes=index - 120).isoformat())
+               for index in range(int(config.jira_max_results * 2.5))]
+    fake_client = FakeJiraClient(tickets)
+    monkeypatch.setattr(jira_store, "client", fake_client)
+    store = JiraStore(str(tmpdir.join("jira_store.sqlite")))
+    assert store.sync() == len(tickets)
+    assert len(fake_client.queries) == 3
+    assert sorted(key for key, in store.connection.execute("SELECT key FROM tickets")) == \
+        sorted(ticket.key for ticket in tickets)
+
+
+def test_jira_store_reload(tmpdir):
+    """
+    Steps:
+        Match a string, add a ticket that contains it, and match it again before and after the
+        sync watermark of the store changes
+    Expected:
+        The loaded tickets should be reused until the watermark changes, and then reloaded
+    """
+    store = JiraStore(str(tmpdir.join("jira_store.sqlite")))
+    assert store.match(["volume is mapped"]) == {"volume is mapped": []}
+    store.connection.execute("INSERT INTO tickets VALUES (?, ?, ?, 'Open', NULL, 0)",
+                             TICKETS[0][:3])
+    assert store.match(["volume is mapped"]) == {"volume is mapped": []}
+    store.connection.execute("INSERT INTO sync_state VALUES ('updated', 1)")
+    assert [ticket.key for ticket in store.match(["volume is mapped"])["volume is mapped"]] == \
+        ["INFRA-1"]
@@ -0,0 +1,23 @@
+from processing_tests import _project_is_automation
+
+
+def test_project_is_automation():
+    """
+    Steps:
+        Check tests with the projected session metadata keys, and a test whose projected source has
+        no session metadata at all
+    Expected:
+        1. Tests of automation projects, old infra tests and suites without a project are automation
+        2. Tests without session metadata are not automation, and don't fail the check
+    """
+    tests = [({"Project": "infinibox_tests"}, True),
+             ({"Project": "other_project"}, False),
+             ({"infinitest-version": "1.0"}, True),
+             ({"slash::commandline": "slash run suite.txt"}, True),
+             ({"Project": "other_project", "slash::commandline": "slash run suite.txt"}, False),
+             (None, False)]
+    for session_metadata, is_automation in tests:
+        source = {"test": {"name": "test_create_pool"}}
+        if session_metadata is not None:
+            source["session_metadata"] = session_metadata
+        assert bool(_project_is_automation({"_source": source})) == is_automation
@@ -0,0 +1,71 @@
+import arrow
+
+import query_cache
+from elastic_search_queries import get_tests_query
+
+NOW = arrow.get("2026-10-18T05:00:00+00:00")
+
+TESTS = {"today": "2026-10-18T03:00:00+00:00",
+         "yesterday": "2026-10-17T12:00:00+00:00",
+         "updated_today": "2026-10-18T02:00:00+00:00",
+         "first_day": "2026-10-16T10:00:00+00:00",
+         "before_window": "2026-10-16T02:00:00+00:00"}
+
+
+class FakeElasticSearch(object):
+    """
+    Return the tests that match the update time range of the partition query
+    """
+
+    def __init__(self):
+        self.live_partitions = []
+
+    def _get_tests(self, query):
+        updated_at = query['query']['bool']['must'][-1]['range']['updated_at']
+        return [{"_id": test_id, "_source": {"updated_at": test_updated_at}}
+                for test_id, test_updated_at in TESTS.items()
+                if arrow.get(updated_at['gte']) <= arrow.get(test_updated_at) <
+                arrow.get(updated_at['lt'])]
+
+    def iter_query_results(self, query):
+        self.live_partitions.append(
+            query['query']['bool']['must'][-1]['range']['updated_at']['gte'][:10])
+        return iter(self._get_tests(query))
+
+    def post_query_request(self, query):
+        return self._get_tests(query)
+
+
+def test_iter_partitioned_results(monkeypatch):
+    """
+    Steps:
+        Get the tests of the last 2 days, when one of the closed days is already cached with an
+        older version of a test that was updated today
+    Expected:
+        1. The current day should be fetched live, and only the missing closed day should be
+            fetched and cached. The cached closed day should be used as is, without fetching it
+        2. Tests of the first day that were updated before the window should be filtered out
+        3. Test that appears in several days should be returned once, with its latest update
+    """
+    cache = {}
+
+    def add_to_cache(key_name, data, days_to_keep=None):
+        cache[key_name] = data
+
+    monkeypatch.setattr(arrow, "utcnow", lambda: NOW)
+    monkeypatch.setattr(query_cache, "get_from_cache", cache.get)
+    monkeypatch.setattr(query_cache, "add_to_cache", add_to_cache)
+    query = get_tests_query(status=["ERROR"])
+    query_key = query_cache._get_query_key(query_cache._with_updated_at(query))
+    cached_test = {"_id": "updated_today", "_source": {"updated_at": "2026-10-17T08:00:00+00:00"}}
+    cache[f"es_partition_{query_key}_2026-10-17"] = [cached_test]
+    elastic_search = FakeElasticSearch()
+    tests = list(query_cache.iter_partitioned_results(elastic_search, query, 2))
+    assert [(test['_id'], test['_source']['updated_at']) for test in tests] == [
+        ("today", TESTS["today"]), ("updated_today", TESTS["updated_today"]),
+        ("first_day", TESTS["first_day"])]
+    assert elastic_search.live_partitions == ["2026-10-18"]
+    assert sorted(cache) == [f"es_partition_{query_key}_2026-10-16",
+                             f"es_partition_{query_key}_2026-10-17"]
+    assert [test['_id'] for test in cache[f"es_partition_{query_key}_2026-10-16"]] == \
+        ["first_day", "before_window"]
@@ -0,0 +1,82 @@
+import atexit
+import threading
+
+import cache_client
+from cache_client import SharedCache, shared_cached
+
+
+def test_shared_cache(tmpdir, monkeypatch):
+    """
+    Steps:
+        1. Get keys of a new cache in bulk from the shared cache, and save the snapshot
+        2. Use another cache with the same snapshot file
+    Expected:
+        1. The snapshot should be loaded only on the first use of the cache, and not when it's
+            created
+        2. Only the keys that are missing from the snapshot should be got from the shared cache
+    """
+    shared_keys = []
+
+    def get_many(key_names):
+        key_names = list(key_names)
+        shared_keys.extend(key_names)
+        return {key_name: ["ticket"] for key_name in key_names}
+
+    monkeypatch.setattr(cache_client, "get_many", get_many)
+    monkeypatch.setattr(atexit, "register", lambda func: None)
+    snapshot_file = str(tmpdir.join("jira_cache.pickle"))
+    cache = SharedCache("jira", maxsize=10, ttl=60, negative_ttl=10, snapshot=True,
+                        snapshot_file=snapshot_file)
+    assert not tmpdir.listdir()
+    for key, value in cache.get_many_shared(["a", "b"]).items():
+        cache[key] = value
+    cache.save_snapshot()
+    shared_keys.clear()
+    restored_cache = SharedCache("jira", maxsize=10, ttl=60, negative_ttl=10, snapshot=True,
+                                 snapshot_file=snapshot_file)
+    assert len(restored_cache) == 0
+    assert "a" in restored_cache and len(restored_cache) == 2
+    assert restored_cache.get_many_shared(key for key in ["a", "c"]
+                                          if key not in restored_cache) == {"c": ["ticket"]}
+    assert len(shared_keys) == 1
+
+
+def test_shared_cached(monkeypatch):
+    """
+    Steps:
+        Call a function that is cached by shared_cached with the same arguments, and with
+        arguments whose result is in the shared cache
+    Expected:
+        1. The function should be called only for missing results, which are added to the shared
+            cache, with the ttl of empty values if they are empty
+        2. The lock should not be held during the calls to the shared cache
+    """
+    lock = threading.Lock()
+    shared_values = {}
+    added_ttls = []
+
+    def get_many(key_names):
+        assert not lock.locked()
+        return {key_name: shared_values[key_name] for key_name in key_names
+                if key_name in shared_values}
+
+    def set_many(items, days_to_keep=None):
+        assert not lock.locked()
+        shared_values.update(items)
+        added_ttls.append(round(days_to_keep * 24 * 60 * 60))
+
+    monkeypatch.setattr(cache_client, "get_many", get_many)
+    monkeypatch.setattr(cache_client, "set_many", set_many)
+    cache = SharedCache("jira", maxsize=10, ttl=60, negative_ttl=10)
+    calls = []
+
+    @shared_cached(cache, lock)
+    def search(query_string):
+        calls.append(query_string)
+        return [query_string] if query_string != "missing" else []
+
+    assert [search("a"), search("a"), search("missing")] == [["a"], ["a"], []]
+    assert calls == ["a", "missing"] and added_ttls == [60, 10]
+    other_cache = SharedCache("jira", maxsize=10, ttl=60, negative_ttl=10)
+    assert shared_cached(other_cache, lock)(search.__wrapped__)("a") == ["a"]
+    assert calls == ["a", "missing"]
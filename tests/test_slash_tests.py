@@ -0,0 +1,25 @@
+import slash_tests
+
+TESTS = {"tests/pools/test_pool.py:test_create_pool": [{"test_name": "test_create_pool"}],
+         "tests/pools/test_pool.py:TestPool.test_resize": [{"test_name": "test_resize"}],
+         "tests/volumes/test_volume.py:test_create_volume": [{"test_name": "test_create_volume"}],
+         "tests/volumes/test_pool_volume.py:test_map": [{"test_name": "test_map"}]}
+
+
+def _find_all_tests(partial_test_name, include_dir_names):
+    return {test_key for test_key, tests in TESTS.items() if partial_test_name in test_key and
+            (include_dir_names or partial_test_name in tests[0]['test_name'])}
+
+
+def test_tests_index_find():
+    """
+    Steps:
+        Find tests by long, short and missing partial names, with and without dir names
+    Expected:
+        The index should find the same tests as checking all the tests
+    """
+    tests_index = slash_tests.TestsIndex(TESTS)
+    for partial_test_name in ["pool", "test_create", "te", "", "volume.py:test", "missing"]:
+        for include_dir_names in [True, False]:
+            assert set(tests_index.find(partial_test_name, include_dir_names)) == \
+                   _find_all_tests(partial_test_name, include_dir_names)
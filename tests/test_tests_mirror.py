@@ -0,0 +1,101 @@
+import arrow
+import pytest
+
+import tests_mirror
+
+NOW = arrow.utcnow().floor('minute')
+
+
+def _get_test(test_id, hours_ago, status="ERROR", version="5.0.1", error=None):
+    return {"_id": test_id, "_source": {
+        "test": {"name": f"test_{test_id}", "file_name": "tests/test_pool.py"},
+        "subjects": [{"version": version, "name": "ibox1"}], "status": status,
+        "errors": [{"message": error}] if error else [], "start_time": 0,
+        "updated_at": NOW.shift(hours=-hours_ago).isoformat(),
+        "session_metadata": {"Project": "infinibox_tests", "Build URL": "jenkins/job/1"}}}
+
+
+TESTS = [_get_test("d", 10), _get_test("c", 15), _get_test("b", 5, error="50%_done: failed"),
+         _get_test("a", 20, status="SUCCESS", version="5.1.0")]
+
+
+class FakeElasticSearch(object):
+    """
+    Return the tests that were updated since the query range, by the query sort, in pages of two
+    tests. If fail_after_pages is set, fail after returning that number of pages
+    """
+
+    def __init__(self, fail_after_pages=None):
+        self.fail_after_pages = fail_after_pages
+
+    def iter_query_pages(self, query):
+        updated_after = arrow.get(query['query']['bool']['must'][-1]['range']['updated_at']['gte'])
+        tests = [test for test in TESTS if arrow.get(test['_source']['updated_at']) >= updated_after]
+        for sort in reversed(query['sort']):
+            (field, order), = sort.items()
+            tests.sort(key=lambda test: test['_id'] if field == '_id' else test['_source'][field],
+                       reverse=order == "desc")
+        for index in range(0, len(tests), 2):
+            if index // 2 == self.fail_after_pages:
+                raise ConnectionError("Connection aborted")
+            yield tests[index:index + 2]
+
+
+def test_tests_mirror_interrupted_sync(tmpdir):
+    """
+    Steps:
+        Sync the mirror when the sync fails after the first page, and sync it again
+    Expected:
+        The second sync should mirror all the tests, including the tests of the failed page
+    """
+    mirror = tests_mirror.TestsMirror(str(tmpdir.join("tests_mirror.sqlite")))
+    with pytest.raises(ConnectionError):
+        mirror.sync(FakeElasticSearch(fail_after_pages=1))
+    mirror.sync(FakeElasticSearch())
+    assert [test['_id'] for test in mirror.iter_test_results()] == ["d", "c", "b", "a"]
+
+
+def test_tests_mirror_concurrent_read(tmpdir):
+    """
+    Steps:
+        Commit a page of the sync while another connection is in the middle of reading the mirror
+    Expected:
+        1. The commit should not fail with "database is locked"
+        2. The reader should keep its snapshot of the tests until its read is done
+    """
+    file_path = str(tmpdir.join("tests_mirror.sqlite"))
+    mirror = tests_mirror.TestsMirror(file_path)
+    mirror.sync(FakeElasticSearch())
+    reading_mirror = tests_mirror.TestsMirror(file_path)
+    reading_mirror.connection.execute("BEGIN")
+    assert reading_mirror.connection.execute("SELECT COUNT(*) FROM tests").fetchone() == (4,)
+    syncing_mirror = tests_mirror.TestsMirror(file_path)
+    syncing_mirror.connection.execute("PRAGMA busy_timeout=0")
+    with syncing_mirror.connection:
+        syncing_mirror.connection.execute("DELETE FROM tests WHERE id = 'a'")
+    assert reading_mirror.connection.execute("SELECT COUNT(*) FROM tests").fetchone() == (4,)
+    reading_mirror.connection.rollback()
+    assert reading_mirror.connection.execute("SELECT COUNT(*) FROM tests").fetchone() == (3,)
+
+
+def test_tests_mirror_conditions(tmpdir):
+    """
+    Steps:
+        Query the mirror by status, version prefix and error with like wildcards
+    Expected:
+        1. The conditions should match the get_tests_query filters
+        2. The wildcards in the error should be matched literally
+    """
+    mirror = tests_mirror.TestsMirror(str(tmpdir.join("tests_mirror.sqlite")))
+    mirror.sync(FakeElasticSearch())
+    assert tests_mirror._get_conditions({"status": "ERROR", "version": "5.0"}) == (
+        ["status IN (?)", "version >= ? AND version < ?"], ["ERROR", "5.0", "5.0\U0010ffff"])
+    assert tests_mirror._get_conditions({"include_simulator": True, "days": None}) == ([], [])
+    queries = [({"status": ["ERROR"]}, ["d", "c", "b"]),
+               ({"version": "5.1"}, ["a"]),
+               ({"error": "50%_done"}, ["b"]),
+               ({"error": "50_"}, []),
+               ({"test_name": "test_c", "jenkins_build": "job/1", "coverage": True}, ["c"]),
+               ({"days": 0.5, "include_simulator": False}, ["d", "b"])]
+    for kwargs, test_ids in queries:
+        assert [test['_id'] for test in mirror.iter_test_results(**kwargs)] == test_ids
@@ -0,0 +1,189 @@
+import json
+import os
+import sqlite3
+import time
+
+import arrow
+import baker
+
+import config
+import log
+from elastic_search_queries import ElasticSearch, get_tests_query
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    id TEXT PRIMARY KEY,
+    test_name TEXT,
+    test_file TEXT,
+    version TEXT,
+    system TEXT,
+    status TEXT,
+    error_type TEXT,
+    start_time REAL,
+    updated_at REAL,
+    project TEXT,
+    build_url TEXT,
+    source TEXT);
+CREATE TABLE IF NOT EXISTS errors (test_id TEXT, message TEXT);
+CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value REAL);
+CREATE INDEX IF NOT EXISTS tests_test_name ON tests (test_name);
+CREATE INDEX IF NOT EXISTS tests_test_file ON tests (test_file);
+CREATE INDEX IF NOT EXISTS tests_version ON tests (version);
+CREATE INDEX IF NOT EXISTS tests_status ON tests (status);
+CREATE INDEX IF NOT EXISTS tests_error_type ON tests (error_type);
+CREATE INDEX IF NOT EXISTS tests_start_time ON tests (start_time);
+CREATE INDEX IF NOT EXISTS tests_updated_at ON tests (updated_at);
+CREATE INDEX IF NOT EXISTS errors_test_id ON errors (test_id);
+"""
+
+WATERMARK = "updated_at"
+
+
+class TestsMirror(object):
+    """
+    Local copy of the backslash tests, that is kept up to date by sync() and can answer the same
+    queries as get_tests_query
+    """
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path if file_path else os.path.join(config.get_util_dir(),
+                                                                  config.tests_mirror_file)
+        self.connection = sqlite3.connect(self.file_path)
+        # Readers don't block the sync and aren't blocked by it while it commits a page
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def sync(self, elastic_search=None):
+        """
+        1. Get the latest update time of the mirrored tests, if the mirror is empty, start from
+            config.mirror_initial_days ago. Move it back by config.mirror_watermark_overlap, to
+            include tests that were indexed late
+        2. Fetch all the tests that were updated since then, ordered by their update time, and
+            insert them to the mirror, replacing the previous version of the tests that were
+            updated
+        3. Save the latest update time with each page. Since the pages are ordered by update time,
+            all the tests before it are already mirrored, so an interrupted sync resumes from the
+            last saved page
+        :type elastic_search: ElasticSearch
+        :rtype: int
+        """
+        elastic_search = elastic_search if elastic_search else ElasticSearch()
+        watermark = self._get_watermark()
+        if watermark is None:
+            watermark = arrow.utcnow().shift(days=-config.mirror_initial_days).float_timestamp
+        updated_after = arrow.get(watermark - config.mirror_watermark_overlap)
+        log.info(f"Syncing tests that were updated since {updated_after}")
+        query = get_tests_query(status=config.all_statuses, fields=config.mirror_source_fields)
+        query['sort'] = [{"updated_at": "asc"}, {"_id": "asc"}]
+        query['query']['bool']['must'].append(
+            {"range": {"updated_at": {"gte": updated_after.isoformat()}}})
+        num_of_tests = 0
+        for page in elastic_search.iter_query_pages(query):
+            with self.connection:
+                for test in page:
+                    watermark = max(watermark, self._insert_test(test))
+                self._set_watermark(watermark)
+            num_of_tests += len(page)
+        log.info(f"{num_of_tests} tests were synced")
+        return num_of_tests
+
+    def _insert_test(self, test):
+        """
+        Insert or replace the test and its errors and return its update time
+        :type test: dict
+        :rtype: float
+        """
+        test_data = test['_source']
+        subject = test_data['subjects'][0] if test_data.get('subjects') else {}
+        errors = test_data.get('errors') or []
+        session_metadata = test_data.get('session_metadata') or {}
+        updated_at = arrow.get(test_data['updated_at']).float_timestamp
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (test['_id'], test_data['test']['name'], test_data['test']['file_name'],
+             subject.get('version'), subject.get('name'), test_data['status'],
+             errors[0]['message'].split(":")[0] if errors else None, test_data['start_time'],
+             updated_at, session_metadata.get('Project'), session_metadata.get('Build URL'),
+             json.dumps(test_data)))
+        self.connection.execute("DELETE FROM errors WHERE test_id = ?", (test['_id'],))
+        self.connection.executemany("INSERT INTO errors VALUES (?, ?)",
+                                    [(test['_id'], error['message']) for error in errors])
+        return updated_at
+
+    def _get_watermark(self):
+        row = self.connection.execute("SELECT value FROM sync_state WHERE name = ?",
+                                      (WATERMARK,)).fetchone()
+        return row[0] if row else None
+
+    def _set_watermark(self, watermark):
+        self.connection.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                                (WATERMARK, watermark))
+
+    def iter_test_results(self, **kwargs):
+        """
+        Yield the mirrored tests that match the given get_tests_query kwargs, in the same format
+        and order as they are returned by the elastic search
+        :rtype: Iterator[dict]
+        """
+        conditions, values = _get_conditions(kwargs)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        cursor = self.connection.execute(
+            f"SELECT id, source FROM tests {where} ORDER BY id DESC, start_time ASC", values)
+        for test_id, source in cursor:
+            yield {"_id": test_id, "_source": json.loads(source)}
+
+
+def _get_conditions(kwargs):
+    """
+    Translate get_tests_query kwargs into sql conditions and their values
+    :type kwargs: dict
+    :rtype: tuple(list, list)
+    """
+    conditions = []
+    values = []
+    if kwargs.get('test_name') is not None:
+        conditions.append("test_name = ?")
+        values.append(kwargs['test_name'])
+    if kwargs.get('error') is not None:
+        conditions.append("EXISTS (SELECT 1 FROM errors WHERE errors.test_id = tests.id AND "
+                          "errors.message LIKE ? ESCAPE '\\')")
+        values.append(f"%{_escape_like(kwargs['error'])}%")
+    if kwargs.get('days') is not None:
+        conditions.append("updated_at > ?")
+        values.append(time.time() - float(kwargs['days']) * 24 * 60 * 60)
+    if kwargs.get('updated_after') is not None:
+        conditions.append("updated_at >= ?")
+        values.append(arrow.get(kwargs['updated_after']).float_timestamp)
+    if kwargs.get('status') is not None:
+        statuses = [kwargs['status']] if isinstance(kwargs['status'], str) else kwargs['status']
+        conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+        values.extend(statuses)
+    if kwargs.get('version') is not None:
+        conditions.append("version >= ? AND version < ?")
+        values.extend([kwargs['version'], f"{kwargs['version']}\U0010ffff"])
+    if kwargs.get('jenkins_build') is not None:
+        conditions.append("build_url LIKE ? ESCAPE '\\'")
+        values.append(f"%{_escape_like(kwargs['jenkins_build'])}%")
+    if kwargs.get("include_simulator") is False:
+        conditions.append("(system IS NULL OR system != 'simulator_1')")
+    if kwargs.get('coverage'):
+        conditions.append("project = 'infinibox_tests' AND test_file NOT LIKE 'tests/test_utils_tests%'")
+    return conditions, values
+
+
+def _escape_like(value):
+    return str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+@baker.command
+def sync_tests_mirror(file_path=None):
+    """
+    Fetch all the tests that were updated since the last sync into the local tests mirror
+    :type file_path: str
+    """
+    TestsMirror(file_path).sync()
+
+
+if __name__ == '__main__':
+    log.init_log(log_file=False)
+    baker.run()
@@ -8,11 +8,12 @@ import baker
 import config
 import log
 import reporting
-from coverage import determine_flaky_tests, update_errors
-from elastic_search_queries import process_error
-from jira_queries import get_ticket_status
-from processing_tests import get_tests, get_sorted_tests_list
-from slash_tests import get_latest_tests
+from coverage import RepoTestsIndex, classify_flaky_tests, get_version_errors, \
+    get_version_executions
+from elastic_search_queries import ElasticSearch, process_error
+from jira_queries import get_tickets_status
+from processing_tests import get_sorted_tests_list
+from slash_tests import get_latest_tests, get_latest_tests_index
 from test_stats import get_related_tests_from_cache, divide_tests_by_filename, get_tests_stats
 
 COMMAND_OUTPUT = namedtuple("CommandOutput", 'html file_name')
@@ -42,13 +43,15 @@ def _process_input(input):
 @baker.command
 def coverage_by_version(version, include_simulator=False, save_static_link=False, save_to_db=None):
     """
-    1. Get all tests executed on specific version
+    1. Get all tests executed on specific version, only the tests that were updated since the
+        previous run are fetched
     2. Get all tests from repo
     3. Create copy of tests repo not_covred list
     3. Iterate through all the tests
-        3.1 If test exists in repo, remove it form the not covered list
+        3.1 If test exists in repo, remove it form the not covered list. The matching repo tests
+            are resolved using index of the repo tests
         3.2 Based on the test result, add it to the test dict that separates success and faulire
-        3.3 Gather all errors in the tests
+        3.3 Count all errors in the failed tests on the server
     4 Determine flaky tests
     5. Generate report
     """
@@ -56,33 +59,29 @@ def coverage_by_version(version, include_simulator=False, save_static_link=False
     repo_tests = {key_name: tests for key_name, tests in get_latest_tests().items() if
                       not key_name.startswith("tests/test_utils_tests")}
 
-    tests = get_tests(version=version, include_simulator=include_simulator,
-                      status=config.all_statuses, coverage=True)
+    executions = get_version_executions(version, include_simulator)
 
     executed_tests = {"SUCCESS": {},
-                      'ERROR': {},
-                      f"Last_{config.definite_executions_threshold}_SUCCESS": {},
-                      f"Last_{config.definite_executions_threshold}_ERROR": {}}
-    errors = {}
-    if tests and repo_tests:
+                      'ERROR': {}}
+    errors = get_version_errors(version, include_simulator)
+    if repo_tests:
         not_covered = repo_tests.copy()
-        for index, test in enumerate(tests):
+        repo_tests_index = RepoTestsIndex(repo_tests)
+        for index, test in enumerate(executions):
             log.debug(f"{index} : {test.start_time}")
             log.debug(test.test_name)
-            for test_key in repo_tests:
-                if test.test_name in test_key and test.test_module in test_key:
-                    if test_key in not_covered:
-                        not_covered.pop(test_key)
-                    if test_key in executed_tests[test._status]:
-                        executed_tests[test._status][test_key].append(test.start_time)
-                    else:
-                        executed_tests[test._status][test_key] = [test.start_time]
-                    update_errors(test, errors)
-        flaky_tests = determine_flaky_tests(executed_tests, repo_tests)
+            for test_key in repo_tests_index.resolve(test.test_module, test.test_name):
+                if test_key in not_covered:
+                    not_covered.pop(test_key)
+                if test_key in executed_tests[test.status]:
+                    executed_tests[test.status][test_key].append(test.start_time)
+                else:
+                    executed_tests[test.status][test_key] = [test.start_time]
+        flaky_classification = classify_flaky_tests(executed_tests, repo_tests)
         coverage_data = {'not_executed': [test_key for test_key, test_list in not_covered.items() if not _get_test_blocker(test_list[0])],
                          'blocked': [test_key for test_key, test_list in not_covered.items() if _get_test_blocker(test_list[0])],
-                         'flaky': flaky_tests}
-        coverage_data.update(executed_tests)
+                         'flaky': flaky_classification.flaky_tests}
+        coverage_data.update(flaky_classification.executed_tests)
         html_text = reporting.create_coverage_report(header=f"Coverage for version {version}",
                                                 coverage_data=coverage_data, errors=errors)
         file_name = f"{version.replace('.', '_')}__coverage_report" \
@@ -106,18 +105,20 @@ def show_jira_blockers(save_static_link=False):
     tests = get_latest_tests()
     if tests:
         blocked_tests = {}
-        for test_key, test_list in tests.items():
-            test_blocker = _get_test_blocker(test_list[0])
-            if test_blocker:
-                status = get_ticket_status(test_blocker)
-                if status in blocked_tests:
-                    blocked_tests[status].append(
-                        {'test': test_key, 'test_blocker': config.jira_link.format(test_blocker),
-                         'status': status})
-                else:
-                    blocked_tests[status] = [
-                        {'test': test_key, 'test_blocker': config.jira_link.format(test_blocker),
-                         'status': status}]
+        test_blockers = {test_key: _get_test_blocker(test_list[0])
+                         for test_key, test_list in tests.items()
+                         if _get_test_blocker(test_list[0])}
+        statuses = get_tickets_status(test_blockers.values())
+        for test_key, test_blocker in test_blockers.items():
+            status = statuses[test_blocker]
+            if status in blocked_tests:
+                blocked_tests[status].append(
+                    {'test': test_key, 'test_blocker': config.jira_link.format(test_blocker),
+                     'status': status})
+            else:
+                blocked_tests[status] = [
+                    {'test': test_key, 'test_blocker': config.jira_link.format(test_blocker),
+                     'status': status}]
         sorted_blocked_tests = OrderedDict(sorted(blocked_tests.items(), reverse=True))
         html_text = reporting.create_test_blockers_table(sorted_blocked_tests)
         return COMMAND_OUTPUT(reporting.handle_html_report(html_text, save_as_file=save_static_link,
@@ -156,14 +157,10 @@ def find_tests_by_name_in_repo(partial_test_name, create_suite_file=False, inclu
      from these tests
     """
     partial_test_name = _process_input(partial_test_name)
-    tag_tests = get_latest_tests()
+    tests_index = get_latest_tests_index()
     file_name = ''
-    if tag_tests:
-        if include_dir_names:
-            selected_tests = set(test_key for test_key, _ in tag_tests.items() if partial_test_name in test_key)
-        else:
-            selected_tests = set(test_key for test_key, tests in tag_tests.items() if
-                                 partial_test_name in test_key and partial_test_name in tests[0]['test_name'])
+    if tests_index:
+        selected_tests = set(tests_index.find(partial_test_name, include_dir_names))
         if create_suite_file:
             suite_tests = '\n'.join(selected_tests)
             file_path = reporting.save_to_file(suite_tests,
@@ -256,6 +253,8 @@ def obtain_all_test_errors(days=1, with_jira_tickets=False, include_simulator=Fa
     2. get all tests in the list
     3. filter out successful tests and test that were executed using local auto code
     4. Update tests with errors
+    The report lists every failed test under its error, so the tests must be fetched. For the
+    error counts alone, use errors_histogram, that counts them on the server
     """
 
     def update_errors():
@@ -292,6 +291,23 @@ def obtain_all_test_errors(days=1, with_jira_tickets=False, include_simulator=Fa
                                                        send_email=send_email), '')
 
 
+@baker.command
+def errors_histogram(days=1, include_simulator=False, save_static_link=False):
+    """
+    Count the failed tests by their exception type. The counting is done on the server, so the
+    tests themselves are not fetched
+    :type days: int
+    :type include_simulator: bool
+    :type save_static_link: bool
+    """
+    errors = ElasticSearch().get_error_counts(days=days, status=config.failed_statuses,
+                                              include_simulator=include_simulator)
+    html_text = reporting.create_errors_histogram(f"Errors in the last {days} days", errors)
+    return COMMAND_OUTPUT(reporting.handle_html_report(html_text, save_as_file=save_static_link,
+                                                       message=f"Errors in the last {days} days"),
+                          '')
+
+
 @baker.command
 def obtain_errors_by_jenkins_build(jenkins_url, save_static_link=True):
     failed_tests = get_sorted_tests_list(jenkins_build=jenkins_url, status=config.failed_statuses)